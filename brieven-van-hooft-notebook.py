@@ -58,63 +58,478 @@ def __():
     #these are the main imports
     import marimo as mo
     import polars
+    import numpy
+    import altair as alt
     from natsort import natsorted
     import stam
 
     import os
     import os.path
-    from urllib.request import urlretrieve
+    import bisect
+    import hashlib
+    import itertools
+    import json
+    import multiprocessing
+    import multiprocessing.connection
+    import re
+    import subprocess
+    import sys
+    import threading
+    import time
+    import types
+    from collections import OrderedDict
+    from contextlib import contextmanager
+    from concurrent.futures import ThreadPoolExecutor
+    from html import escape
+    from urllib.error import HTTPError, URLError
+    from urllib.request import Request, urlopen
+
+    return (
+        HTTPError,
+        OrderedDict,
+        Request,
+        ThreadPoolExecutor,
+        URLError,
+        alt,
+        bisect,
+        contextmanager,
+        escape,
+        hashlib,
+        itertools,
+        json,
+        mo,
+        multiprocessing,
+        natsorted,
+        numpy,
+        os,
+        polars,
+        re,
+        stam,
+        subprocess,
+        sys,
+        threading,
+        time,
+        types,
+        urlopen,
+    )
 
-    return mo, natsorted, os, polars, stam, urlretrieve
 
 @app.cell
-def __(mo, natsorted, os, polars, stam, urlretrieve):
-    import hashlib
+def data_files(HTTPError, Request, ThreadPoolExecutor, URLError, hashlib, json, os, threading, time, urlopen):
+    #these are helper functions to download the data and verify its integrity
+
+    def sha256_file(filename, chunksize=1024*1024):
+        """Computes the sha256 digest of a file, reading it in chunks so it need not be held in memory entirely"""
+        m = hashlib.sha256()
+        with open(filename,'rb') as f:
+            while chunk := f.read(chunksize):
+                m.update(chunk)
+        return m.hexdigest()
+
+    def fetch_file(url, filename, retries=3, chunksize=1024*1024, timeout=60):
+        """Downloads a file, hashing it while streaming. The data is written to a temporary `.part` file that
+        is only renamed to `filename` once the download is complete. An existing `.part` file from an
+        interrupted earlier download is resumed using a HTTP Range request. Returns the sha256 digest."""
+        partfile = filename + ".part"
+        for attempt in range(retries + 1):
+            m = hashlib.sha256()
+            offset = 0
+            if os.path.exists(partfile):
+                #the digest has to cover the part we already have
+                with open(partfile,'rb') as f:
+                    while chunk := f.read(chunksize):
+                        m.update(chunk)
+                        offset += len(chunk)
+            try:
+                request = Request(url, headers={"Range": f"bytes={offset}-"} if offset else {})
+                with urlopen(request, timeout=timeout) as response:
+                    if offset and response.status != 206:
+                        #the server ignored our range request and sends everything, start over
+                        m = hashlib.sha256()
+                        offset = 0
+                    expected = response.headers.get("Content-Length")
+                    received = 0
+                    with open(partfile,'ab' if offset else 'wb') as f:
+                        while chunk := response.read(chunksize):
+                            f.write(chunk)
+                            m.update(chunk)
+                            received += len(chunk)
+                    if expected is not None and received < int(expected):
+                        raise URLError(f"connection closed after {offset + received} bytes")
+                break
+            except HTTPError as e:
+                if e.code == 416 and offset:
+                    #range not satisfiable: the earlier download was already complete
+                    break
+                if attempt == retries:
+                    raise
+            except (URLError, OSError):
+                if attempt == retries:
+                    raise
+            #back off before retrying, the partial download is kept and resumed
+            time.sleep(2 ** attempt)
+        os.replace(partfile, filename)
+        return m.hexdigest()
+
+    def fetch_files(sources):
+        """Downloads all files that do not exist yet, concurrently. `sources` maps filenames to URLs.
+        Returns a dictionary mapping each downloaded filename to its sha256 digest."""
+        missing = { filename: url for filename, url in sources.items() if not os.path.exists(filename) }
+        if not missing:
+            return {}
+        with ThreadPoolExecutor(max_workers=len(missing)) as pool:
+            futures = { filename: pool.submit(fetch_file, url, filename) for filename, url in missing.items() }
+            return { filename: future.result() for filename, future in futures.items() }
+
+    def verify_files(checksums, manifest_file="hoof001hwva.verified.json", force=False, digests=None):
+        """Verifies the files against the expected checksums (a dictionary mapping filenames to sha256 digests).
+        Files are hashed in parallel. The size, modification time and digest of each file are recorded in a manifest,
+        files that are unchanged since they were last hashed are not hashed again, unless `force` is set.
+        Digests that are already known (e.g. because they were computed while downloading) can be passed as `digests`.
+        Returns a dictionary mapping each filename to a boolean indicating whether it passed."""
+        manifest = {}
+        if not force and os.path.exists(manifest_file):
+            with open(manifest_file,'r',encoding='utf-8') as f:
+                manifest = json.load(f)
+        known = digests or {}
+        digests = {}
+        rehash = []
+        for filename in checksums:
+            stat = os.stat(filename)
+            entry = manifest.get(filename)
+            if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns and filename not in known:
+                digests[filename] = entry["sha256"]
+            else:
+                manifest[filename] = { "size": stat.st_size, "mtime_ns": stat.st_mtime_ns }
+                if filename in known:
+                    manifest[filename]["sha256"] = digests[filename] = known[filename]
+                else:
+                    rehash.append(filename)
+        if rehash:
+            #hashlib releases the GIL while hashing, so threads suffice to hash the files in parallel
+            with ThreadPoolExecutor(max_workers=len(rehash)) as pool:
+                for filename, digest in zip(rehash, pool.map(sha256_file, rehash)):
+                    manifest[filename]["sha256"] = digests[filename] = digest
+        if rehash or known:
+            #written under a temporary name first, so that others never read a partially written manifest
+            tmpfilename = f"{manifest_file}.{os.getpid()}.{threading.get_ident()}.part"
+            with open(tmpfilename,'w',encoding='utf-8') as f:
+                json.dump(manifest, f, indent=4)
+            os.replace(tmpfilename, manifest_file)
+        return { filename: digests[filename] == checksum for filename, checksum in checksums.items() }
+
+    return fetch_file, fetch_files, sha256_file, verify_files
+
+
+@app.cell
+def shared_objects(sys, threading, types):
+    #with `marimo run`, every browser session runs the notebook anew, but all sessions are threads in the same process.
+    #Large read-only objects (the store and the indices derived from it) are shared between those sessions through a
+    #process-wide registry, so only the first session has to load them and memory does not grow with each session.
+    _registry = types.ModuleType("brieven_van_hooft_shared")
+    _registry.objects = {}
+    _registry.locks = {}
+    _registry.lock = threading.Lock()
+    _registry = sys.modules.setdefault(_registry.__name__, _registry)
+
+    def shared(key, factory):
+        """Returns the process-wide shared object for the key, the first caller creates it with factory() while
+        concurrent callers wait for it. Shared objects must not be modified.
+        Outside of the main thread only: if the notebook runs in the main thread (as a script or in its own kernel
+        process in edit mode) there are no other sessions to share with, and factory() is simply called."""
+        if threading.current_thread() is threading.main_thread():
+            return factory()
+        with _registry.lock:
+            _lock = _registry.locks.setdefault(key, threading.Lock())
+        with _lock:
+            if key not in _registry.objects:
+                _registry.objects[key] = factory()
+            return _registry.objects[key]
+
+    return shared,
+
+
+@app.cell
+def __(contextmanager, json, os, polars, time):
+    #a small profiling hook API: cells report the duration of their stages (and measurements such as result counts
+    #or output size) into `profiler`, the diagnostics section at the end of the notebook shows and exports these
+
+    class Profiler:
+        """Collects records reported by cells. Each record holds the cell, the stage, its duration in seconds,
+        the resident memory of the process afterwards, and any further measurements"""
+
+        def __init__(self, max_records=10000):
+            self.records = []
+            self.max_records = max_records
+            self.begintime = time.time()
+
+        @staticmethod
+        def rss_kb():
+            """Returns the current resident memory of this process in kB, or None if it can not be determined (non-Linux)"""
+            try:
+                with open("/proc/self/statm", "r") as f:
+                    return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+            except (OSError, ValueError, AttributeError):
+                return None
+
+        def record(self, cell, stage, seconds=None, **measurements):
+            _record = { "timestamp": time.time(), "cell": cell, "stage": stage, "seconds": seconds, "rss_kb": self.rss_kb() }
+            _record.update(measurements)
+            self.records.append(_record)
+            del self.records[:-self.max_records]
+            return _record
+
+        @contextmanager
+        def stage(self, cell, stage, **measurements):
+            """Records the duration of the code in the with-block, further measurements can be added to the yielded dictionary"""
+            _begintime = time.perf_counter()
+            try:
+                yield measurements
+            finally:
+                self.record(cell, stage, time.perf_counter() - _begintime, **measurements)
+
+        def table(self):
+            return polars.from_dicts(self.records, infer_schema_length=None) if self.records else polars.DataFrame()
+
+        def export(self):
+            """Returns all records as JSON"""
+            return json.dumps({ "started": self.begintime, "rss_kb": self.rss_kb(), "records": self.records }, indent=4, default=str)
+
+    profiler = Profiler()
+    return Profiler, profiler
+
+
+@app.cell
+def __(hashlib, json, mo, os):
+    #load profiles: not every use of the notebook needs all annotations, a profile loads only the chosen annotation
+    #data sets (None means all). Each profile is derived from the full STAM model once and cached as its own store.
+    load_profiles = {
+        "full": None,
+        "manual linguistic": [
+            "http://www.w3.org/ns/anno/", "brieven-van-hooft-metadata", "brieven-van-hooft-categories",
+            "https://w3id.org/folia/v2/", "gustave-pos", "gustave-lem",
+        ],
+        "metadata only": [ "http://www.w3.org/ns/anno/", "brieven-van-hooft-metadata", "brieven-van-hooft-categories" ],
+    }
+
+    def profile_checksum(checksum, datasets):
+        """Returns the checksum identifying the store derived from the STAM model with the given checksum,
+        restricted to the given annotation data sets (the checksum itself if all sets are loaded)"""
+        if datasets is None:
+            return checksum
+        return hashlib.sha256("\n".join([checksum] + sorted(datasets)).encode("utf-8")).hexdigest()
+
+    def filter_store_json(filename, datasets):
+        """Reads a STAM JSON file and returns it as STAM JSON (a string) holding only the annotation data from the given
+        sets. Annotations without any remaining data are left out, as are annotations that target left out annotations."""
+        with open(filename, 'r', encoding='utf-8') as f:
+            model = json.load(f)
+        datasets = set(datasets)
+
+        def referenced(selector):
+            if "annotation" in selector:
+                yield selector["annotation"]
+            for subselector in selector.get("selectors", ()):
+                yield from referenced(subselector)
+
+        model["annotationsets"] = [ annotationset for annotationset in model.get("annotationsets", []) if annotationset.get("@id", None) in datasets or "@include" in annotationset ]
+        annotations = []
+        for annotation in model.get("annotations", []):
+            annotation["data"] = [ data for data in annotation.get("data", []) if data.get("set") in datasets ]
+            if annotation["data"]:
+                annotations.append(annotation)
+        #annotations may target annotations that follow them, so repeat until nothing more is left out
+        while True:
+            ids = { annotation.get("@id") for annotation in annotations }
+            kept = [ annotation for annotation in annotations if all(target in ids for target in referenced(annotation["target"])) ]
+            if len(kept) == len(annotations):
+                break
+            annotations = kept
+        model["annotations"] = annotations
+        return json.dumps(model)
+
+    _default = os.environ.get("BRIEVEN_VAN_HOOFT_PROFILE", "full")
+    load_profile = mo.ui.dropdown(options=list(load_profiles), value=_default if _default in load_profiles else "full", label="Load profile")
+    mo.md(f"""
+    If you only need part of the annotations, you can choose a smaller load profile, which loads faster and takes less memory: *metadata only* loads the letters with their metadata and categories, *manual linguistic* adds the manually assigned part-of-speech tags and lemmas (but not the automatic ones), *full* loads everything.
+    Deriving a profile takes a while the first time, it is cached afterwards. The default can be set with the environment variable `BRIEVEN_VAN_HOOFT_PROFILE`.
+
+    {load_profile}
+    """)
+    return filter_store_json, load_profile, load_profiles, profile_checksum
+
 
+@app.cell
+def __(
+    fetch_files,
+    filter_store_json,
+    json,
+    load_profile,
+    load_profiles,
+    mo,
+    natsorted,
+    os,
+    polars,
+    profile_checksum,
+    profiler,
+    shared,
+    stam,
+    threading,
+    time,
+    verify_files,
+):
     #download and load the data
-    if not os.path.exists("hoof001hwva02.txt"):
-        urlretrieve("https://www.dbnl.org/nieuws/text.php?id=hoof001hwva02","hoof001hwva02.txt")
-    if not os.path.exists("hoof001hwva03.txt"):
-        urlretrieve("https://www.dbnl.org/nieuws/text.php?id=hoof001hwva03","hoof001hwva03.txt")
-    if not os.path.exists("hoof001hwva04.txt"):
-        urlretrieve("https://www.dbnl.org/nieuws/text.php?id=hoof001hwva04","hoof001hwva04.txt")
-    if not os.path.exists("hoof001hwva.output.store.stam.json"):
+    _data_sources = {
+        "hoof001hwva02.txt": "https://www.dbnl.org/nieuws/text.php?id=hoof001hwva02",
+        "hoof001hwva03.txt": "https://www.dbnl.org/nieuws/text.php?id=hoof001hwva03",
+        "hoof001hwva04.txt": "https://www.dbnl.org/nieuws/text.php?id=hoof001hwva04",
         #TODO: adapt link to Zenodo before final publication
-        urlretrieve("https://download.anaproy.nl/hoof001hwva.output.store.stam.json","hoof001hwva.output.store.stam.json")
-        os.sync()
-    _data_downloaded = "✅"
-
-    _checksums = {
+        "hoof001hwva.output.store.stam.json": "https://download.anaproy.nl/hoof001hwva.output.store.stam.json",
+    }
+    data_checksums = {
         "hoof001hwva02.txt":"5f0df29a5ea14e87bc66c3a8e8012ec966a8a948b709cc80504c6fb5c2e9d82b",
         "hoof001hwva03.txt":"4c0a23a238b6da382c6a0c5334a867d8e3ef4cb081aae37c5104cf612cbeb64a",
         "hoof001hwva04.txt":"6a2f9c4454f0db71a84c774418edaa9adc4ee19a5b3da00f051dd8c6b2f691df",
         "hoof001hwva.output.store.stam.json": "f56baccb3dc8ca88d1f6327f806c173a954391e42c5236e76cc5a9284e7521ec"
     }
-    _data_integrity = "✅"
-    _msg = ""
-    for _filename, _checksum in _checksums.items():
-        _m = hashlib.sha256()
-        with open(_filename,'rb') as _f:
-            _m.update(_f.read())
-        if _m.hexdigest() != _checksum:
+    #concurrent sessions (under `marimo run`) must not download into the same files, nor verify them while they are
+    #being downloaded, so this is done by one session at a time, later sessions find the files present and verified
+    with shared("data files lock", threading.Lock):
+        try:
+            with profiler.stage("loading", "download") as _measurements:
+                _fetched = fetch_files(_data_sources)
+                _measurements["files"] = len(_fetched)
+            _data_downloaded = "✅"
+            _download_msg = ""
+        except OSError as _e:
+            _fetched = {}
+            _data_downloaded = "❌"
+            _download_msg = f"\n* Download failed: {_e}. Partial downloads are kept and will be resumed on the next attempt."
+        if _fetched and hasattr(os, "sync"):
+            os.sync()
+        with profiler.stage("loading", "verify"):
+            _verified = verify_files(data_checksums, digests=_fetched) if _data_downloaded == "✅" else {}
+    _data_integrity = "✅" if _data_downloaded == "✅" else "❌"
+    _msg = _download_msg
+    for _filename, _passed in _verified.items():
+        if not _passed:
             _data_integrity = "❌"
             if _filename.endswith(".txt"): 
                 _msg += f"\n* Checksum for {_filename} failed! This means that the plain text data for Brieven van Hooft at DBNL has changed and that either you need to obtain the older files, or the annotation pipeline needs to be rerun! (contact hennie.brugman@di.huc.knaw.nl and proycon@anaproy.nl)"
             elif _filename.endswith(".json"): 
                 _msg += f"\n* Checksum for {_filename} failed! This means that STAM model for Brieven van Hooft has changed and the notebook needs to adapt to the new version (contact hennie.brugman@di.huc.knaw.nl and proycon@anaproy.nl)"
     
-    if _data_downloaded and _data_integrity == "✅":
-        #load the STAM model (AnnotationStore) into the variable `store`
-        store = stam.AnnotationStore(file="hoof001hwva.output.store.stam.json")
+    if _data_downloaded == "✅" and _data_integrity == "✅":
+        #load the STAM model (AnnotationStore) into the variable `store`, the store is shared with other sessions
+        _loaded = {}
+        _datasets = load_profiles[load_profile.value]
+        _checksum = profile_checksum(data_checksums["hoof001hwva.output.store.stam.json"], _datasets)
+        #parsing the JSON is slow, so after the first load we write a binary (CBOR) snapshot of the store
+        #that is tied to the checksum of the JSON file (and load profile) and the stam version, and load that on later starts
+        if _datasets is None:
+            _snapshot_file = "hoof001hwva.output.store.stam.cbor"
+            _snapshot_info_file = "hoof001hwva.output.snapshot.json"
+        else:
+            _snapshot_file = f"hoof001hwva.output.{_checksum[:16]}.store.stam.cbor"
+            _snapshot_info_file = f"hoof001hwva.output.snapshot.{_checksum[:16]}.json"
+
+        def _load_store():
+            _snapshot_info = {}
+            if os.path.exists(_snapshot_file) and os.path.exists(_snapshot_info_file):
+                with open(_snapshot_info_file,'r',encoding='utf-8') as _f:
+                    _snapshot_info = json.load(_f)
+            _store = None
+            if _snapshot_info.get("sha256") == _checksum and _snapshot_info.get("stam_version") == stam.VERSION:
+                _begintime = time.perf_counter()
+                try:
+                    with profiler.stage("loading", "load snapshot", profile=load_profile.value):
+                        _store = stam.AnnotationStore(file=_snapshot_file)
+                    _load_note = f"(from snapshot in {time.perf_counter() - _begintime:.1f}s, parsing the JSON took {_snapshot_info['json_load_seconds']:.1f}s)"
+                except stam.StamError:
+                    _store = None
+            if _store is None:
+                _begintime = time.perf_counter()
+                if _datasets is None:
+                    with profiler.stage("loading", "parse JSON"):
+                        _store = stam.AnnotationStore(file="hoof001hwva.output.store.stam.json")
+                else:
+                    #the profile's store is derived from the full STAM JSON, leaving out the annotations of other sets
+                    with profiler.stage("loading", "parse JSON", profile=load_profile.value):
+                        _store = stam.AnnotationStore(string=filter_store_json("hoof001hwva.output.store.stam.json", _datasets))
+                _json_load_seconds = time.perf_counter() - _begintime
+                _load_note = f"(from JSON in {_json_load_seconds:.1f}s)"
+                try:
+                    #the info file marks the snapshot as complete, so it is removed before and written after the snapshot itself.
+                    #Both are written under a temporary name first, so that other processes (e.g. a batch run next to the
+                    #notebook) writing the same snapshot never leave a partially written file behind
+                    if os.path.exists(_snapshot_info_file):
+                        os.unlink(_snapshot_info_file)
+                    _tmpsuffix = f".{os.getpid()}.{threading.get_ident()}.part"
+                    #(stam appends .store.stam.cbor to filenames that do not end with it)
+                    _tmpfilename = _snapshot_file.replace(".store.stam.cbor", _tmpsuffix + ".store.stam.cbor")
+                    _begintime = time.perf_counter()
+                    with profiler.stage("loading", "write snapshot"):
+                        _store.to_file(_tmpfilename)
+                        os.replace(_tmpfilename, _snapshot_file)
+                    _snapshot_info = {
+                        "sha256": _checksum,
+                        "source_sha256": data_checksums["hoof001hwva.output.store.stam.json"],
+                        "datasets": _datasets,
+                        "stam_version": stam.VERSION,
+                        "json_load_seconds": _json_load_seconds,
+                        "snapshot_write_seconds": time.perf_counter() - _begintime,
+                    }
+                    with open(_snapshot_info_file + _tmpsuffix,'w',encoding='utf-8') as _f:
+                        json.dump(_snapshot_info, _f, indent=4)
+                    os.replace(_snapshot_info_file + _tmpsuffix, _snapshot_info_file)
+                    _load_note += ", wrote a snapshot for faster loading next time"
+                except (stam.StamError, OSError) as _e:
+                    _load_note += f", unable to write snapshot: {_e}"
+            _loaded["note"] = _load_note
+            return _store
+
+        store = shared(("store", _checksum, stam.VERSION), _load_store)
+        #the info file is only present along with a complete snapshot of this store, custom queries run in worker processes loading it
+        store_snapshot = os.path.abspath(_snapshot_file) if os.path.exists(_snapshot_info_file) else None
+        _load_note = _loaded.get("note", "(shared with other sessions)")
+        if _datasets is not None:
+            _load_note += f", load profile: *{load_profile.value}*"
         _data_loaded = "✅"
     else:
         store = None
+        store_snapshot = None
         _data_loaded = "❌"
+        _load_note = ""
 
-    _md = f"* Data download ready {_data_downloaded}\n* Data integrity check? {_data_integrity} {_msg}\n* Data loaded? {_data_loaded}\n"
+    _md = f"* Data download ready {_data_downloaded}\n* Data integrity check? {_data_integrity} {_msg}\n* Data loaded? {_data_loaded} {_load_note}\n"
     mo.stop(store is None, mo.md(_md))
     mo.md(_md)
-    return store
+    return data_checksums, store, store_snapshot
+
+
+@app.cell
+def __(mo, store):
+    mo.stop(store is None)
+    reverify_button = mo.ui.run_button(label="Re-verify data integrity")
+    mo.md(f"""
+    Unchanged files are not hashed again on later starts, you can force a full verification of all data files here: {reverify_button}
+    """)
+    return reverify_button,
+
+
+@app.cell
+def __(data_checksums, mo, reverify_button, verify_files):
+    #this cell runs a full verification of the data on demand, ignoring the memoized results
+    if reverify_button.value:
+        _failed = [ _filename for _filename, _passed in verify_files(data_checksums, force=True).items() if not _passed ]
+        if _failed:
+            _md = mo.md("* Data integrity check? ❌ Checksum failed for: " + ", ".join(_failed))
+        else:
+            _md = mo.md("* Data integrity check? ✅ (full verification)")
+    else:
+        _md = None
+    _md
+    return
 
 
 @app.cell
@@ -192,32 +607,746 @@ def __(chosen_dataset, mo, store):
 
 
 @app.cell
-def __(store):
+def __(data_checksums, load_profile, load_profiles, os, profile_checksum, threading):
+    #derived data (indices, tables) is cached on disk next to the STAM model, tied to its checksum (and load profile)
+    store_checksum = profile_checksum(data_checksums["hoof001hwva.output.store.stam.json"], load_profiles[load_profile.value])
+
+    def cache_filename(name, extension="parquet"):
+        """Returns the filename for a cache file holding derived data for the current STAM model"""
+        return f"hoof001hwva.output.{name}.{store_checksum[:16]}.{extension}"
+
+    def write_cache(dataframe, filename):
+        """Writes a table to a Parquet cache file. The file is written under a temporary name first, so that
+        other sessions never read a partially written cache file."""
+        _tmpfilename = f"{filename}.{os.getpid()}.{threading.get_ident()}.part"
+        dataframe.write_parquet(_tmpfilename)
+        os.replace(_tmpfilename, filename)
+
+    return cache_filename, store_checksum, write_cache
+
+
+@app.cell
+def __(escape, stam):
+    #helper functions to relate annotations to the text they refer to
+
+    def annotation_span(annotation):
+        """Returns (resource id, begin, end) for the text an annotation refers to. If the annotation does not
+        reference text directly, the annotations it targets are followed. Returns None if there is no text."""
+        textselections = list(annotation.textselections())
+        if not textselections:
+            textselections = [ textselection for target in annotation.annotations_in_targets() for textselection in target.textselections() ]
+        if not textselections:
+            return None
+        resource_id = textselections[0].resource().id()
+        textselections = [ textselection for textselection in textselections if textselection.resource().id() == resource_id ]
+        return (resource_id, min(x.begin() for x in textselections), max(x.end() for x in textselections))
+
+    def find_key(store, set_id, key_id):
+        """Returns a data key, or None if it does not exist in the store"""
+        try:
+            return store.key(set_id, key_id)
+        except stam.StamError:
+            return None
+
+    def render_spans(text, offset, spans, title=None):
+        """Returns HTML for a text that starts at `offset` in its resource, with the given (begin, end) spans marked.
+        Span offsets are resource offsets, overlapping spans are merged."""
+        _merged = []
+        for _begin, _end in sorted(spans):
+            if _merged and _begin <= _merged[-1][1]:
+                _merged[-1][1] = max(_merged[-1][1], _end)
+            else:
+                _merged.append([_begin, _end])
+        _html = []
+        _cursor = 0
+        for _begin, _end in _merged:
+            _begin, _end = max(_begin - offset, _cursor), min(_end - offset, len(text))
+            if _end <= _begin:
+                continue
+            _html.append(escape(text[_cursor:_begin]))
+            _html.append(f"<mark>{escape(text[_begin:_end])}</mark>")
+            _cursor = _end
+        _html.append(escape(text[_cursor:]))
+        _title = f"<h3>{escape(title)}</h3>" if title else ""
+        return f"""<div class="spans">{_title}<div style="white-space: pre-wrap; line-height: 1.6em">{"".join(_html)}</div></div>"""
+
+    #colours of highlight layers, each layer is also underlined at its own depth so overlapping layers remain visible
+    _layer_colours = ["#d62728", "#1f77b4", "#2ca02c", "#9467bd", "#ff7f0e", "#8c564b"]
+
+    def render_layers(text, offset, layers, title=None):
+        """Returns HTML for a text that starts at `offset` in its resource, with the spans of each highlight layer underlined.
+        `layers` is a list of (name, spans) where spans are (begin, end, label) in resource offsets, labels that are
+        not None are shown at the start of their span."""
+        _changes = {}
+        _labels = {}
+        for _i, (_, _spans) in enumerate(layers):
+            for _begin, _end, _label in _spans:
+                _begin, _end = max(_begin - offset, 0), min(_end - offset, len(text))
+                if _end <= _begin:
+                    continue
+                _changes.setdefault(_begin, [0] * len(layers))[_i] += 1
+                _changes.setdefault(_end, [0] * len(layers))[_i] -= 1
+                if _label is not None:
+                    _labels.setdefault(_begin, []).append((_i, _label))
+        _html = []
+        _active = [0] * len(layers)
+        _boundaries = sorted(set(_changes) | { 0, len(text) })
+        for _begin, _end in zip(_boundaries, _boundaries[1:]):
+            for _i, _change in enumerate(_changes.get(_begin, ())):
+                _active[_i] += _change
+            for _i, _label in sorted(_labels.get(_begin, [])):
+                _html.append(f"""<sup style="color: {_layer_colours[_i % len(_layer_colours)]}; font-size: 0.7em">{escape(str(_label))}</sup>""")
+            _segment = escape(text[_begin:_end])
+            for _i in range(len(layers)):
+                if _active[_i] > 0:
+                    _segment = f"""<span style="border-bottom: 2px solid {_layer_colours[_i % len(_layer_colours)]}; padding-bottom: {1 + 3 * _i}px">{_segment}</span>"""
+            _html.append(_segment)
+        _legend = " ".join(f"""<span style="color: {_layer_colours[_i % len(_layer_colours)]}">▁ {escape(_name)}</span>""" for _i, (_name, _) in enumerate(layers))
+        _title = f"<h3>{escape(title)}</h3>" if title else ""
+        return f"""<div class="layers">{_title}<div>{_legend}</div><div style="white-space: pre-wrap; line-height: 2.6em">{"".join(_html)}</div></div>"""
+
+    return annotation_span, find_key, render_layers, render_spans
+
+
+@app.cell
+def letter_indices(
+    cache_filename,
+    natsorted,
+    os,
+    polars,
+    shared,
+    store,
+    store_checksum,
+    write_cache,
+):
     # initialize some data we need later
     dataset_metadata = store.dataset("brieven-van-hooft-metadata")
     key_dbnl_id = dataset_metadata.key("dbnl_id")
-    return dataset_metadata, key_dbnl_id
+
+    #index all letters once, so that later cells can do dictionary lookups and polars filters rather than store queries:
+    # * letter_index maps each dbnl_id to the letter annotation
+    # * letter_data_index maps (dataset, key, value) to the dbnl_ids of all letters having that metadata/category
+    # * letters_table is a wide table with one row per letter and a column per metadata/category key (persisted as parquet)
+    #the indices are shared with other sessions
+    letter_datasets = ("brieven-van-hooft-metadata", "brieven-van-hooft-categories")
+
+    def _index_letters():
+        _letter_columns = {}
+        for _dataset_id in letter_datasets:
+            for _key in store.dataset(_dataset_id).keys():
+                #some keys (e.g. function) occur in both sets, the category one gets qualified
+                if _key.id() in _letter_columns.values():
+                    _letter_columns[(_dataset_id, _key.id())] = _dataset_id.split("-")[-1] + "_" + _key.id()
+                else:
+                    _letter_columns[(_dataset_id, _key.id())] = _key.id()
+        _letter_index = {}
+        _letter_data_index = {}
+        _columns = {}
+        for _letter in key_dbnl_id.annotations():
+            _dbnl_id = str(next(_letter.data(key_dbnl_id)))
+            _letter_index[_dbnl_id] = _letter
+            for _data in _letter.data():
+                _dataset_id = _data.dataset().id()
+                if _dataset_id in letter_datasets:
+                    _key_id = _data.key().id()
+                    _letter_data_index.setdefault((_dataset_id, _key_id, str(_data)), []).append(_dbnl_id)
+                    _columns.setdefault(_letter_columns[(_dataset_id, _key_id)], {})[_dbnl_id] = _data.value().get()
+
+        _letters_file = cache_filename("letters")
+        if os.path.exists(_letters_file):
+            _letters_table = polars.read_parquet(_letters_file)
+        else:
+            _dbnl_ids = natsorted(_letter_index)
+            _data = { "dbnl_id": _dbnl_ids }
+            for _column in _letter_columns.values():
+                if _column in _columns and _column != "dbnl_id":
+                    _values = [ _columns[_column].get(_dbnl_id) for _dbnl_id in _dbnl_ids ]
+                    if len({ type(_value) for _value in _values if _value is not None }) > 1:
+                        #mixed types can not be stored in a single column
+                        _values = [ None if _value is None else str(_value) for _value in _values ]
+                    _data[_column] = _values
+            _letters_table = polars.DataFrame(_data)
+            write_cache(_letters_table, _letters_file)
+        return _letter_columns, _letter_index, _letter_data_index, _letters_table
+
+    letter_columns, letter_index, letter_data_index, letters_table = shared(("letter_index", store_checksum), _index_letters)
+    return (
+        dataset_metadata,
+        key_dbnl_id,
+        letter_columns,
+        letter_data_index,
+        letter_datasets,
+        letter_index,
+        letters_table,
+    )
+
+
+@app.cell
+def letter_interval_index(annotation_span, letter_index, numpy, polars, shared, store_checksum):
+    #an interval index from text offsets to letters: per resource, the offsets of all letters are kept in sorted
+    #arrays, so the letters that any annotations are in can be found in bulk by binary search
+
+    class LetterIntervals:
+        """Maps offsets in the text resources to the letters they are in"""
+
+        def __init__(self, letter_index):
+            _letters = {}
+            for _dbnl_id, _letter in letter_index.items():
+                _span = annotation_span(_letter)
+                if _span is not None:
+                    _letters.setdefault(_span[0], []).append((_span[1], _span[2], _dbnl_id))
+            self.intervals = {}
+            for _resource, _spans in _letters.items():
+                _spans.sort()
+                self.intervals[_resource] = (
+                    numpy.array([ _span[0] for _span in _spans ], dtype=numpy.int64),
+                    numpy.array([ _span[1] for _span in _spans ], dtype=numpy.int64),
+                    numpy.array([ _span[2] for _span in _spans ], dtype=object),
+                )
+
+        def lookup(self, resource, offsets):
+            """Returns an array with the dbnl_id of the letter each offset (in the resource) is in, or None"""
+            offsets = numpy.asarray(offsets, dtype=numpy.int64)
+            _result = numpy.full(len(offsets), None, dtype=object)
+            if resource not in self.intervals:
+                return _result
+            _begins, _ends, _dbnl_ids = self.intervals[resource]
+            _i = numpy.searchsorted(_begins, offsets, side="right") - 1
+            _found = _i >= 0
+            _found[_found] = offsets[_found] < _ends[_i[_found]]
+            _result[_found] = _dbnl_ids[_i[_found]]
+            return _result
+
+        def count(self, spans):
+            """Takes (resource, begin, end) spans (e.g. of annotations) and returns a table with the number of spans
+            that start in each letter (dbnl_id, occurrences), most occurrences first"""
+            _offsets = {}
+            for _resource, _begin, _ in spans:
+                _offsets.setdefault(_resource, []).append(_begin)
+            _dbnl_ids = [ _dbnl_id for _resource, _begins in _offsets.items() for _dbnl_id in self.lookup(_resource, _begins) if _dbnl_id is not None ]
+            return polars.DataFrame({ "dbnl_id": _dbnl_ids }, schema={ "dbnl_id": polars.Utf8 }).group_by("dbnl_id").len().rename({ "len": "occurrences" }).sort(["occurrences", "dbnl_id"], descending=[True, False])
+
+    letter_intervals = shared(("letter_intervals", store_checksum), lambda: LetterIntervals(letter_index))
+    return LetterIntervals, letter_intervals
+
+
+@app.cell
+def __(cache_filename, natsorted, os, polars, store, write_cache):
+    #compute the vocabulary statistics (value counts) for all keys of all datasets in one pass, so the
+    #vocabulary explorer does not need to walk the store each time another dataset or key is selected.
+    #the natural sort order of the values is stored as a rank so it needn't be recomputed for each view
+    _vocabulary_file = cache_filename("vocabulary")
+    if os.path.exists(_vocabulary_file):
+        vocabulary_table = polars.read_parquet(_vocabulary_file)
+    else:
+        _columns = { "Dataset": [], "Key": [], "Value": [], "Occurrences": [], "Rank": [] }
+        for _dataset in store.datasets():
+            for _key in _dataset.keys():
+                _values = []
+                for _data in _key.data():
+                    _values.append(str(_data))
+                    _columns["Occurrences"].append(_data.annotations_len())
+                _ranks = [0] * len(_values)
+                for _rank, _i in enumerate(natsorted(range(len(_values)), key=_values.__getitem__)):
+                    _ranks[_i] = _rank
+                _columns["Dataset"] += [_dataset.id()] * len(_values)
+                _columns["Key"] += [_key.id()] * len(_values)
+                _columns["Value"] += _values
+                _columns["Rank"] += _ranks
+        vocabulary_table = polars.DataFrame(_columns, schema={ "Dataset": polars.Utf8, "Key": polars.Utf8, "Value": polars.Utf8, "Occurrences": polars.UInt32, "Rank": polars.UInt32 })
+        write_cache(vocabulary_table, _vocabulary_file)
+    return vocabulary_table,
+
+
+@app.cell
+def __(OrderedDict, re, shared, store_checksum, threading):
+    #query results (the views of custom queries and the highlight layers of letters) are cached, so re-running a cell
+    #with the same query (e.g. after an unrelated checkbox changed, or when resubmitting a custom query) is instant
+
+    class QueryCache:
+        """Least-recently-used cache for query results, bounded by the number of bytes the results take"""
+
+        def __init__(self, max_bytes=256 * 1024 * 1024):
+            self.max_bytes = max_bytes
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+            self.entries = OrderedDict()
+            #the cache may be shared by multiple sessions
+            self.lock = threading.Lock()
+
+        @staticmethod
+        def normalize(query):
+            """Normalizes a query string by collapsing whitespace outside of quoted strings"""
+            parts = re.split(r'("(?:[^"\\]|\\.)*")', query.strip())
+            return "".join(part if i % 2 else re.sub(r"\s+", " ", part) for i, part in enumerate(parts))
+
+        def lookup(self, cachekey):
+            """Returns the cached result for the key, or None if there is none"""
+            with self.lock:
+                if cachekey in self.entries:
+                    self.hits += 1
+                    self.entries.move_to_end(cachekey)
+                    return self.entries[cachekey][0]
+                self.misses += 1
+                return None
+
+        def add(self, cachekey, result, size):
+            with self.lock:
+                if cachekey not in self.entries and size <= self.max_bytes:
+                    self.entries[cachekey] = (result, size)
+                    self.size += size
+                    while self.size > self.max_bytes:
+                        _, (_, evictedsize) = self.entries.popitem(last=False)
+                        self.size -= evictedsize
+
+        def get(self, cachekey, compute, sizeof):
+            result = self.lookup(cachekey)
+            if result is None:
+                result = compute()
+                self.add(cachekey, result, sizeof(result))
+            return result
+
+        @classmethod
+        def view_key(cls, query, **kwargs):
+            """Returns the key for the view (store.view()) of a query"""
+            return ("view", cls.normalize(query), tuple(sorted(kwargs.items())))
+
+        def stats(self):
+            return { "hits": self.hits, "misses": self.misses, "entries": len(self.entries), "bytes": self.size }
+
+    query_cache = shared(("query_cache", store_checksum), QueryCache)
+    return QueryCache, query_cache
+
+
+@app.cell
+def query_jobs(json, shared, subprocess, sys, threading, time):
+    #custom queries run in a worker, so that a slow query does not block the notebook and can be cancelled.
+    #The worker is a separate process that loads the store from its snapshot once and evaluates one query at a time.
+    #It is started anew rather than forked, as a fork of the notebook server would inherit its threads (and the locks
+    #they hold) midway. A worker is killed when its query is cancelled or times out, and then replaced by a new one.
+    #Without a snapshot the query runs in a thread, which can not be stopped, so its result is discarded instead
+
+    class QueryWorker:
+        """A worker process, started by running this notebook with the `worker` command"""
+
+        #the notebook file (set by marimo, or when run as a script)
+        notebook = globals().get("__file__")
+
+        def __init__(self, snapshot):
+            self.snapshot = snapshot
+            self.process = subprocess.Popen([sys.executable, self.notebook, "worker", snapshot], stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE, text=True, encoding="utf-8")
+
+        def evaluate(self, query, profile, explain):
+            """Sends a query to the worker and waits for its outcome: (html, stats, explanation, error).
+            Raises EOFError if the worker is gone"""
+            self.process.stdin.write(json.dumps({ "query": query, "profile": profile, "explain": explain }) + "\n")
+            self.process.stdin.flush()
+            #waiting for the worker does not hold the GIL
+            _line = self.process.stdout.readline()
+            if not _line:
+                raise EOFError(f"worker process died (exit code {self.process.wait()})")
+            return tuple(json.loads(_line))
+
+        def kill(self):
+            self.process.kill()
+            self.process.wait()
+
+        @staticmethod
+        def serve(store, explain, requests, responses):
+            """The main loop of the worker process: evaluates each query read (as a JSON line) from requests and
+            writes its outcome to responses"""
+            for _line in requests:
+                _request = json.loads(_line)
+                try:
+                    _outcome = (*QueryJob._evaluate(store, _request["query"], _request["profile"], explain if _request["explain"] else None), None)
+                except Exception as e:
+                    _outcome = (None, {}, None, str(e))
+                responses.write(json.dumps(_outcome) + "\n")
+                responses.flush()
+
+    class QueryWorkers:
+        """The idle workers (per snapshot), shared by all sessions"""
+
+        def __init__(self, max_idle=1):
+            self.max_idle = max_idle
+            self.idle = {}
+            self._lock = threading.Lock()
+
+        def acquire(self, snapshot):
+            """Returns an idle worker for the snapshot, or starts one. Raises OSError if no worker can be started"""
+            with self._lock:
+                _idle = self.idle.get(snapshot, [])
+                while _idle:
+                    _worker = _idle.pop()
+                    if _worker.process.poll() is None:
+                        return _worker
+            return QueryWorker(snapshot)
+
+        def release(self, worker):
+            """Returns a worker that finished its query"""
+            with self._lock:
+                _idle = self.idle.setdefault(worker.snapshot, [])
+                if len(_idle) < self.max_idle:
+                    _idle.append(worker)
+                    return
+            #enough workers are idle already, closing its input ends the worker
+            worker.process.stdin.close()
+
+        def replace(self, worker):
+            """Kills a worker (e.g. as its query is cancelled) and starts a new one in its place, which loads the store
+            while it is not needed yet"""
+            worker.kill()
+            try:
+                self.release(QueryWorker(worker.snapshot))
+            except OSError:
+                pass
+
+    query_workers = shared("query_workers", QueryWorkers)
+
+    class QueryJob:
+        """Runs store.view(query) in a worker, the job is cancelled once it runs longer than `timeout` seconds.
+        The status is one of: running, done, failed, cancelled, timeout. If `profile` is set, the worker first evaluates
+        the query separately to measure query time and result count (in `stats`) apart from the view time.
+        If `explain` is set, the worker also calls explain(store, query) and keeps its outcome (in `explanation`).
+        If `snapshot` (the file the store was loaded from) is set, the worker is a process loading that file."""
+
+        def __init__(self, store, query, timeout=60, profile=False, explain=None, snapshot=None):
+            self.query = query
+            self.timeout = timeout
+            self.html = None
+            self.error = None
+            self.stats = {}
+            self.explanation = None
+            #set once the outcome has been reported (to the profiler)
+            self.reported = False
+            self.status = "running"
+            self.begintime = time.perf_counter()
+            self.endtime = None
+            self.worker = None
+            self._lock = threading.Lock()
+            self._timer = threading.Timer(timeout, self.cancel, kwargs={"status": "timeout"})
+            self._timer.daemon = True
+            if store is None:
+                #no worker needed
+                return
+            if snapshot is not None and QueryWorker.notebook is not None:
+                try:
+                    self.worker = query_workers.acquire(snapshot)
+                except OSError:
+                    self.worker = None
+            if self.worker is not None:
+                threading.Thread(target=self._delegate, args=(profile, explain is not None), daemon=True).start()
+            else:
+                threading.Thread(target=self._run, args=(store, query, profile, explain), daemon=True).start()
+            self._timer.start()
+
+        @classmethod
+        def finished(cls, query, html):
+            """Returns a job that is already done, for results that were obtained without a worker (e.g. from cache)"""
+            job = cls(None, query)
+            job._finish(html, { "cached": True }, None, None)
+            return job
+
+        @staticmethod
+        def _evaluate(store, query, profile, explain):
+            """Returns the view of the query along with statistics and the explanation (if requested)"""
+            _stats = {}
+            if profile:
+                _begintime = time.perf_counter()
+                _stats["results"] = len(store.query(query))
+                _stats["query_seconds"] = time.perf_counter() - _begintime
+            _begintime = time.perf_counter()
+            _html = store.view(query)
+            _stats["view_seconds"] = time.perf_counter() - _begintime
+            return _html, _stats, explain(store, query) if explain else None
+
+        def _delegate(self, profile, explain):
+            try:
+                _outcome = self.worker.evaluate(self.query, profile, explain)
+            except (EOFError, OSError, ValueError) as e:
+                #the worker was killed (if the job was cancelled, this changes nothing) or died
+                if self._finish(None, {}, None, str(e)):
+                    query_workers.replace(self.worker)
+                return
+            if self._finish(*_outcome):
+                query_workers.release(self.worker)
+
+        def _run(self, store, query, profile, explain):
+            try:
+                self._finish(*self._evaluate(store, query, profile, explain), None)
+            except Exception as e:
+                self._finish(None, {}, None, str(e))
+
+        def _finish(self, html, stats, explanation, error, status=None):
+            with self._lock:
+                if self.status != "running":
+                    return False
+                self.html = html
+                self.stats = stats
+                self.explanation = explanation
+                self.error = error
+                self.status = status or ("failed" if error else "done")
+                self.endtime = time.perf_counter()
+            self._timer.cancel()
+            return True
+
+        def cancel(self, status="cancelled"):
+            if self._finish(None, {}, None, None, status) and self.worker is not None:
+                query_workers.replace(self.worker)
+
+        def elapsed(self):
+            return (self.endtime or time.perf_counter()) - self.begintime
+
+    return QueryJob, QueryWorker, QueryWorkers, query_workers
+
+
+@app.cell
+def query_explanation(re, stam, time):
+    #explain mode for custom queries: the query is split into its subquery levels and constraints, and each level
+    #is evaluated with an increasing number of its constraints, to show where the candidates (and the time) go
+
+    def parse_query(query):
+        """Parses a STAMQL query into a dictionary holding the `select` clause (up to and including WHERE), the
+        `constraints` (as strings) and the `subqueries` (a list of alternatives, each parsed likewise)"""
+        tokens = re.findall(r'"(?:[^"\\]|\\.)*"|[{}|;]|[^"{}|;]+', query)
+
+        def parse(i):
+            node = { "select": None, "constraints": [], "subqueries": [] }
+            pending = ""
+
+            def flush():
+                nonlocal pending
+                text = re.sub(r"\s+", " ", pending).strip()
+                pending = ""
+                if node["select"] is None:
+                    match = re.match(r"(.*?\bWHERE\b)(.*)$", text, re.DOTALL)
+                    node["select"], text = (match.group(1), match.group(2).strip()) if match else (text, "")
+                if text:
+                    node["constraints"].append(text)
+
+            while i < len(tokens):
+                token = tokens[i]
+                if token == ";":
+                    flush()
+                elif token == "{":
+                    flush()
+                    while i < len(tokens) and tokens[i] != "}":
+                        subquery, i = parse(i + 1)
+                        node["subqueries"].append(subquery)
+                elif token in ("|", "}"):
+                    break
+                else:
+                    pending += token
+                i += 1
+            if pending.strip() or node["select"] is None:
+                flush()
+            return node, i
+
+        return parse(0)[0]
+
+    def _variable(node):
+        """Returns the name of the variable a (sub)query selects"""
+        match = re.search(r"\?(\w+)", node["select"])
+        return match.group(1) if match else None
+
+    def _references(constraint):
+        """Returns the names of the variables a constraint refers to (outside of quoted strings)"""
+        return set(re.findall(r"\?(\w+)", re.sub(r'"(?:[^"\\]|\\.)*"', '""', constraint)))
+
+    def _chain_query(chain, constraints):
+        """Returns the query for the last level in the chain of (nested) queries, restricted to the given constraints,
+        and including the preceding levels in full (but not their other subqueries)"""
+        text = chain[-1]["select"] + "".join(f" {constraint};" for constraint in constraints)
+        for node in reversed(chain[:-1]):
+            text = node["select"] + "".join(f" {constraint};" for constraint in node["constraints"]) + " { " + text + " }"
+        return text
+
+    def explain_query(store, query):
+        """Evaluates the query clause by clause. Returns a dictionary with a row per constraint (`clauses`: the number of
+        distinct candidates for the variable of its level after it, and with only that constraint, and the time until then),
+        the time per subquery level (`levels`), the total number of `results` and `seconds`, and `suggestions`.
+        The constraints that relate a level to the enclosing levels are always included, as without them every candidate
+        would be combined with every result of the enclosing levels. A level without such constraints is evaluated on its
+        own and the total number of results (such a cartesian product) is not counted."""
+
+        def evaluate(query, variable):
+            _begintime = time.perf_counter()
+            try:
+                return len({ row[variable] for row in store.query(query) }), time.perf_counter() - _begintime, None
+            except stam.StamError as e:
+                return None, time.perf_counter() - _begintime, str(e).split("\n")[0]
+
+        clauses = []
+        levels = []
+        suggestions = []
+        unrelated = []
+
+        def walk(chain, label, parent_seconds):
+            node = chain[-1]
+            variable = _variable(node)
+            outer = { _variable(ancestor) for ancestor in chain[:-1] }
+            binding = [ constraint for constraint in node["constraints"] if _references(constraint) & outer ]
+            if len(chain) > 1 and not binding:
+                suggestions.append(f"Level {label} (?{variable}) has no constraint relating it to the enclosing query (e.g. `RELATION ?{_variable(chain[-2])} EMBEDS`), "
+                                   f"so every one of its results is combined with every result of the enclosing query")
+                unrelated.append(label)
+                chain = [node]
+                parent_seconds = 0.0
+            seconds = parent_seconds
+            alone = []
+            for n, constraint in enumerate(node["constraints"], 1):
+                _constraints = [ other for i, other in enumerate(node["constraints"]) if i < n or other in binding ]
+                candidates, seconds, error = evaluate(_chain_query(chain, _constraints), variable)
+                #the candidates with only this constraint (besides those relating the level to the enclosing ones) show how selective it is
+                _alone = [ other for other in node["constraints"] if other == constraint or other in binding ]
+                alone.append(evaluate(_chain_query(chain, _alone), variable)[0] if _alone != _constraints else candidates)
+                clauses.append({ "level": label, "variable": f"?{variable}", "clause": n, "constraint": constraint,
+                                 "candidates": candidates, "candidates on its own": alone[-1], "seconds": seconds, "error": error })
+            levels.append({ "level": label, "variable": f"?{variable}", "constraints": len(node["constraints"]), "seconds": max(seconds - parent_seconds, 0.0) })
+            #the order of the constraints relating the level to the enclosing ones is left as it is
+            free = [ n for n, constraint in enumerate(node["constraints"]) if constraint not in binding and alone[n] is not None ]
+            if len(free) > 1:
+                best = min(free, key=lambda n: alone[n])
+                #only worth it if the most selective constraint leaves considerably fewer candidates than the first
+                if best != free[0] and alone[best] * 2 < alone[free[0]]:
+                    suggestions.append(f"Level {label} (?{variable}): put `{node['constraints'][best]}` before `{node['constraints'][free[0]]}`, "
+                                       f"it leaves {alone[best]} candidates rather than {alone[free[0]]}. Order the constraints from most to least selective: "
+                                       + ", ".join(f"`{constraint}`" for constraint in binding + [ node["constraints"][n] for n in sorted(free, key=lambda n: alone[n]) ]))
+            for i, subquery in enumerate(node["subqueries"], 1):
+                walk(chain + [subquery], f"{label}.{i}", seconds)
+
+        walk([parse_query(query)], "1", 0.0)
+        if unrelated:
+            results, seconds, error = None, sum(level["seconds"] for level in levels), None
+        else:
+            _begintime = time.perf_counter()
+            try:
+                results, error = len(store.query(query)), None
+            except stam.StamError as e:
+                results, error = None, str(e).split("\n")[0]
+            seconds = time.perf_counter() - _begintime
+        return { "clauses": clauses, "levels": levels, "results": results, "seconds": seconds, "error": error, "suggestions": suggestions }
+
+    return explain_query, parse_query
+
+
+@app.cell
+def __(
+    annotation_span,
+    cache_filename,
+    find_key,
+    letter_index,
+    os,
+    polars,
+    store,
+    write_cache,
+):
+    #export a token table with one row per FoLiA word (w) along with its linguistic annotations and the sentence,
+    #paragraph, part and letter it is in. This walks the store once and is persisted as Parquet, after which
+    #corpus-wide analytics can be done with (lazy) polars queries rather than many queries on the store.
+    tokens_file = cache_filename("tokens")
+    if not os.path.exists(tokens_file):
+        def _span_table(annotations, columns, id_column=None):
+            """Returns a table with the text span of each annotation and its data, `columns` maps data keys to column names.
+            If `id_column` is set, the annotation's identifier is included in a column by that name."""
+            _rows = { "resource": [], "begin": [], "end": [] }
+            _rows.update({ column: [] for column in columns.values() })
+            if id_column:
+                _rows[id_column] = []
+            for _annotation in annotations:
+                _span = annotation_span(_annotation)
+                if _span is None:
+                    continue
+                for _column, _value in zip(("resource","begin","end"), _span):
+                    _rows[_column].append(_value)
+                if id_column:
+                    _rows[id_column].append(_annotation.id())
+                _values = { columns[(_data.dataset().id(), _data.key().id())]: _data.value().get() for _data in _annotation.data() if (_data.dataset().id(), _data.key().id()) in columns }
+                for _column in columns.values():
+                    _value = _values.get(_column)
+                    _rows[_column].append(_value if _value is None or _column.endswith("confidence") else str(_value))
+            _schema = { "resource": polars.Utf8, "begin": polars.UInt32, "end": polars.UInt32 }
+            _schema.update({ column: polars.Float64 if column.endswith("confidence") else polars.Utf8 for column in columns.values() })
+            if id_column:
+                _schema[id_column] = polars.Utf8
+            return polars.DataFrame(_rows, schema=_schema).unique(subset=["resource","begin","end"], keep="first", maintain_order=True)
+
+        def _key_annotations(set_id, key_id, value=None):
+            _key = find_key(store, set_id, key_id)
+            if _key is None:
+                return []
+            if value is None:
+                return _key.annotations()
+            return [ _annotation for _data in _key.data() if str(_data) == value for _annotation in _data.annotations() ]
+
+        def _assign(tokens, intervals, column):
+            """Adds a column to the tokens holding the value of the interval (e.g. sentence) each token is in"""
+            intervals = intervals.rename({ "begin": "interval_begin", "end": "interval_end" }).sort("interval_begin")
+            return tokens.sort("begin").join_asof(intervals, left_on="begin", right_on="interval_begin", by="resource", strategy="backward").with_columns(
+                polars.when(polars.col("end") <= polars.col("interval_end")).then(polars.col(column)).otherwise(None).alias(column)
+            ).drop("interval_begin", "interval_end")
+
+        _folia = "https://w3id.org/folia/v2/"
+        _tokens = _span_table(_key_annotations(_folia, "elementtype", "w"), {}, id_column="id")
+        _texts = { _resource.id(): _resource.text() for _resource in store.resources() }
+        _tokens = _tokens.with_columns(polars.Series("text", [ _texts[_resource][_begin:_end] for _resource, _begin, _end in _tokens.select("resource","begin","end").iter_rows() ], dtype=polars.Utf8))
+
+        #linguistic annotation layers: the gustave-* sets are the manual annotations, the frog ones are automatic
+        _pos_columns = { ("gustave-pos", "class"): "pos_class", ("gustave-pos", "head"): "pos_head" }
+        if find_key(store, "gustave-pos", "class") is not None:
+            for _key in store.dataset("gustave-pos").keys():
+                _pos_columns.setdefault(("gustave-pos", _key.id()), "pos_" + _key.id())
+        _frog_pos = "http://ilk.uvt.nl/folia/sets/frog-mbpos-cgn"
+        _frog_lemma = "http://ilk.uvt.nl/folia/sets/frog-mblem-nl"
+        for _set_id, _key_id, _columns in (
+            ("gustave-pos", "class", _pos_columns),
+            ("gustave-lem", "class", { ("gustave-lem", "class"): "lemma" }),
+            (_frog_pos, "class", { (_frog_pos, "class"): "frog_pos", (_folia, "confidence"): "frog_pos_confidence" }),
+            (_frog_lemma, "class", { (_frog_lemma, "class"): "frog_lemma", (_folia, "confidence"): "frog_lemma_confidence" }),
+        ):
+            _tokens = _tokens.join(_span_table(_key_annotations(_set_id, _key_id), _columns), on=["resource","begin","end"], how="left")
+
+        #structural context
+        for _column, _intervals in (
+            ("sentence", _span_table(_key_annotations(_folia, "elementtype", "s"), {}, id_column="sentence")),
+            ("paragraph", _span_table(_key_annotations(_folia, "elementtype", "p"), {}, id_column="paragraph")),
+            ("part", _span_table(_key_annotations("brieven-van-hooft-categories", "part"), { ("brieven-van-hooft-categories", "part"): "part" })),
+        ):
+            _tokens = _assign(_tokens, _intervals, _column)
+        _letters = polars.DataFrame(
+            [ (*annotation_span(_letter), _dbnl_id) for _dbnl_id, _letter in letter_index.items() ],
+            schema={ "resource": polars.Utf8, "begin": polars.UInt32, "end": polars.UInt32, "dbnl_id": polars.Utf8 }, orient="row"
+        )
+        _tokens = _assign(_tokens, _letters, "dbnl_id")
+
+        _first = ["dbnl_id", "part", "paragraph", "sentence", "id", "resource", "begin", "end", "text"]
+        write_cache(_tokens.sort("resource","begin").select(_first + [ _column for _column in _tokens.columns if _column not in _first ]), tokens_file)
+    tokens = polars.scan_parquet(tokens_file)
+    return tokens, tokens_file
 
 
 @app.cell
-def __(chosen_key, dataset, mo, natsorted, polars):
+def __(chosen_dataset, chosen_key, mo, polars, vocabulary_table):
     # show the data for the selected data key
-    key = dataset.key(chosen_key.value)
-    vocab_dataframe = polars.DataFrame(
-        data=natsorted((str(x), x.annotations_len()) for x in key.data()),
-        schema=["Value","Occurrences"],
-        orient="row"
-    )
+    vocab_dataframe = vocabulary_table.filter(
+        (polars.col("Dataset") == chosen_dataset.value) & (polars.col("Key") == chosen_key.value)
+    ).sort("Rank").select("Value","Occurrences")
     vocab_selection = mo.ui.table(vocab_dataframe, selection="multi")
     vocab_selection
-    return key, vocab_dataframe, vocab_selection
+    return vocab_dataframe, vocab_selection
 
 
 @app.cell
 def __(
+    annotation_span,
     chosen_dataset,
     chosen_key,
-    key_dbnl_id,
+    find_key,
+    letter_data_index,
+    letter_datasets,
+    letter_intervals,
     mo,
     polars,
     store,
@@ -225,17 +1354,24 @@ def __(
 ):
     #constrain letters given selected data
 
-    data_values = "|".join([str(x[0]) for x in vocab_selection.value.select(polars.selectors.first()).iter_rows()])
+    _values = [str(x[0]) for x in vocab_selection.value.select(polars.selectors.first()).iter_rows()]
+    data_values = "|".join(_values)
     data_query = f"""SELECT ANNOTATION ?a WHERE DATA "{chosen_dataset.value}" "{chosen_key.value}" = "{data_values}";"""
     matching_letters = []
-    for _annotation in store.query(data_query):
-        if _annotation["a"].test_data(key_dbnl_id):
-            matching_letters.append(next(_annotation["a"].data(key_dbnl_id)))
-        #else:
-        #    for _letter in _annotation["a"].related_text(stam.TextSelectionOperator.embedded(), limit=5).annotations(key_dbnl_id):
-        #        _dbnl_id = next(_letter.data(key_dbnl_id))
-        #        if _dbnl_id not in matching_letters:
-        #            matching_letters.append(_dbnl_id)
+    #the number of matching annotations per letter (only for data that is not on the letters themselves)
+    matching_letter_counts = None
+    if chosen_dataset.value in letter_datasets and any(_dataset_id == chosen_dataset.value and _key_id == chosen_key.value for _dataset_id, _key_id, _ in letter_data_index):
+        #letter metadata and categories can be looked up directly in the letter index
+        for _value in _values:
+            for _dbnl_id in letter_data_index.get((chosen_dataset.value, chosen_key.value, _value), []):
+                if _dbnl_id not in matching_letters:
+                    matching_letters.append(_dbnl_id)
+    elif _values:
+        #other annotations (e.g. linguistic ones) are mapped to the letters they are in through the interval index
+        _key = find_key(store, chosen_dataset.value, chosen_key.value)
+        _annotations = [ _annotation for _data in (_key.data() if _key is not None else []) if str(_data) in _values for _annotation in _data.annotations() ]
+        matching_letter_counts = letter_intervals.count(_span for _span in map(annotation_span, _annotations) if _span is not None)
+        matching_letters = matching_letter_counts["dbnl_id"].to_list()
 
     if matching_letters:
         _md = mo.md(f"{len(matching_letters)} matching letters were found (query was: ``{data_query}``), the selection below is constrained accordingly:" )
@@ -244,32 +1380,103 @@ def __(
     else:
         _md = mo.md(f"No constraints provided, select one or more in the above table if you want to constraint the letters shown in the next section")
     _md
-    return data_query, data_values, matching_letters
+    return data_query, data_values, matching_letter_counts, matching_letters
+
+
+@app.cell
+def __(
+    annotation_span,
+    find_key,
+    letter_index,
+    query_cache,
+    render_layers,
+    store,
+):
+    #the letter visualisation highlights layers of annotations, each defined by the (variable, set, key, value)
+    #of one or more subqueries. The spans of each layer are computed once per letter and cached, so toggling a
+    #layer only composes the cached layers anew rather than querying the store again for all layers and letters
+    highlight_layers = {
+        "pos": [ ("pos", "gustave-pos", "class", None) ],
+        "lemma": [ ("lemma", "gustave-lem", "class", None) ],
+        "part": [ ("part", "brieven-van-hooft-categories", "part", None) ],
+        "structure": [ (_value, "https://w3id.org/folia/v2/", "elementtype", _value) for _value in ("w", "p", "s") ],
+    }
+
+    def _data_constraint(set_id, key_id, value):
+        return f"""DATA "{set_id}" "{key_id}" = "{value}";""" if value is not None else f"""DATA "{set_id}" "{key_id}";"""
+
+    def visualisation_query(dbnl_ids, pos=False, lemma=False, part=False, structure=False):
+        """Returns a query to visualise the given letters with the chosen layers highlighted (as in the letter visualisation)"""
+        _enabled = dict(pos=pos, lemma=lemma, part=part, structure=structure)
+        _highlights = [
+            f"""@VALUETAG SELECT OPTIONAL ANNOTATION ?{_variable} WHERE RELATION ?letter EMBEDS; {_data_constraint(_set_id, _key_id, _value)}"""
+            for _layer, _subqueries in highlight_layers.items() if _enabled[_layer] for _variable, _set_id, _key_id, _value in _subqueries
+        ]
+        _highlights = " { " + " | ".join(_highlights) + " }" if _highlights else ""
+        return f"""SELECT ANNOTATION ?letter WHERE DATA "brieven-van-hooft-metadata" "dbnl_id" = "{"|".join(dbnl_ids)}";""" + _highlights
+
+    def letter_layer(dbnl_id, layer, cached=True):
+        """Returns the (begin, end, label) spans of a highlight layer in a letter, the label is the annotation's value"""
+        def _compute():
+            _spans = []
+            for _variable, _set_id, _key_id, _value in highlight_layers[layer]:
+                _key = find_key(store, _set_id, _key_id)
+                if _key is None:
+                    continue
+                for _row in store.query(f"""SELECT ANNOTATION ?letter WHERE DATA "brieven-van-hooft-metadata" "dbnl_id" = "{dbnl_id}"; {{ SELECT ANNOTATION ?{_variable} WHERE RELATION ?letter EMBEDS; {_data_constraint(_set_id, _key_id, _value)} }}"""):
+                    _span = annotation_span(_row[_variable])
+                    if _span is not None:
+                        _spans.append((_span[1], _span[2], next((str(_data) for _data in _row[_variable].data(_key)), None)))
+            return sorted(_spans)
+        if not cached:
+            return _compute()
+        return query_cache.get(("layer", dbnl_id, layer), _compute, lambda spans: 64 + 64 * len(spans))
+
+    def render_letter(dbnl_id, layers):
+        """Returns HTML for a letter with the given (name, spans) layers highlighted"""
+        _textselection = next(letter_index[dbnl_id].textselections())
+        return render_layers(str(_textselection), _textselection.begin(), layers, title=dbnl_id)
+
+    return highlight_layers, letter_layer, render_letter, visualisation_query
+
+
+@app.cell
+def __(mo):
+    #the page of selected letters that is currently being visualised
+    get_letter_page, set_letter_page = mo.state(0)
+    return get_letter_page, set_letter_page
 
 
 @app.cell
-def __(key_dbnl_id, matching_letters, mo, natsorted, polars):
+def __(
+    letters_table,
+    matching_letter_counts,
+    matching_letters,
+    mo,
+    natsorted,
+    polars,
+    set_letter_page,
+):
     #this cell presents a form to view letters and annotations
 
-    if matching_letters:
-        available_letters = polars.DataFrame(
-            data=natsorted((str(x) for x in matching_letters)),
-            schema=["dbnl_id"],
-            orient="row"
-        )
+    if matching_letter_counts is not None and not matching_letter_counts.is_empty():
+        available_letters = matching_letter_counts
+        letter_note = "*(this selection is constrained by your data query above, letters with the most occurrences first!)*"
+    elif matching_letters:
+        available_letters = polars.DataFrame({ "dbnl_id": natsorted(matching_letters) })
         letter_note = "*(this selection is constrained by your data query above!)*"
     else:
-        available_letters = polars.DataFrame(
-            data=natsorted(str(x) for x in key_dbnl_id.data()),
-            schema=["dbnl_id"],
-            orient="row"
-        )
+        available_letters = letters_table.select("dbnl_id")
         letter_note = ""
-    chosen_letters = mo.ui.table(available_letters,selection="multi")
+    chosen_letters = mo.ui.table(available_letters,selection="multi",on_change=lambda _: set_letter_page(0))
     show_pos_annotations = mo.ui.checkbox()
     show_lemma_annotations = mo.ui.checkbox()
     show_part_annotations = mo.ui.checkbox()
     show_structure_annotations = mo.ui.checkbox()
+    #large selections are visualised a page at a time, so output size is bounded by the page rather than the selection
+    letters_per_page = mo.ui.number(start=1, stop=100, value=5, on_change=lambda _: set_letter_page(0))
+    previous_page_button = mo.ui.button(label="← previous", on_click=lambda _: set_letter_page(lambda page: max(page - 1, 0)))
+    next_page_button = mo.ui.button(label="next →", on_click=lambda _: set_letter_page(lambda page: page + 1))
 
     mo.md(f"""
     ## Visualisation of Letters and Annotations
@@ -279,12 +1486,16 @@ def __(key_dbnl_id, matching_letters, mo, natsorted, polars):
     * Show lemma annotations? {show_lemma_annotations}
     * Show part annotations? {show_part_annotations}
     * Show structure annotations from FoLiA? {show_structure_annotations}
+    * Letters per page: {letters_per_page}
 
     """)
     return (
         available_letters,
         chosen_letters,
         letter_note,
+        letters_per_page,
+        next_page_button,
+        previous_page_button,
         show_lemma_annotations,
         show_part_annotations,
         show_pos_annotations,
@@ -295,54 +1506,75 @@ def __(key_dbnl_id, matching_letters, mo, natsorted, polars):
 @app.cell
 def __(
     chosen_letters,
+    get_letter_page,
+    highlight_layers,
+    letter_layer,
+    letters_per_page,
+    letters_table,
     mo,
+    next_page_button,
     polars,
+    previous_page_button,
+    profiler,
+    query_cache,
+    set_letter_page,
     show_lemma_annotations,
     show_part_annotations,
     show_pos_annotations,
+    render_letter,
     show_structure_annotations,
-    store,
+    visualisation_query,
 ):
-    #this cell forms and runs query for letter visualisation and display the results
+    #this cell visualises the selected letters with the chosen layers of annotations highlighted
+    #only the current page of letters is rendered, one letter at a time, and each is appended to the output as soon as it is ready
     if not chosen_letters.value.is_empty():
-        _chosen_letters = "|".join(chosen_letters.value.to_series())
-        query = f"""SELECT ANNOTATION ?letter WHERE DATA "brieven-van-hooft-metadata" "dbnl_id" = "{_chosen_letters}";"""
-        _highlights = []
-        if show_pos_annotations.value:
-            _highlights.append("""@VALUETAG SELECT OPTIONAL ANNOTATION ?pos WHERE RELATION ?letter EMBEDS; DATA "gustave-pos" "class";""")
-        if show_lemma_annotations.value:
-            _highlights.append("""@VALUETAG SELECT OPTIONAL ANNOTATION ?lemma WHERE RELATION ?letter EMBEDS; DATA "gustave-lem" "class";""")
-        if show_part_annotations.value:
-            _highlights.append("""@VALUETAG SELECT OPTIONAL ANNOTATION ?part WHERE RELATION ?letter EMBEDS; DATA "brieven-van-hooft-categories" "part";""")
-        if show_structure_annotations.value:
-            _highlights.append("""@VALUETAG SELECT OPTIONAL ANNOTATION ?w WHERE RELATION ?letter EMBEDS; DATA "https://w3id.org/folia/v2/" "elementtype" = "w";""")
-            _highlights.append("""@VALUETAG SELECT OPTIONAL ANNOTATION ?p WHERE RELATION ?letter EMBEDS; DATA "https://w3id.org/folia/v2/" "elementtype" = "p";""")
-            _highlights.append("""@VALUETAG SELECT OPTIONAL ANNOTATION ?s WHERE RELATION ?letter EMBEDS; DATA "https://w3id.org/folia/v2/" "elementtype" = "s";""")   
-        if _highlights:
-            query += " { " + " | ".join(_highlights) + " }"
+        _letters = chosen_letters.value.to_series().to_list()
+        _pagecount = (len(_letters) + letters_per_page.value - 1) // letters_per_page.value
+        _page = min(get_letter_page(), _pagecount - 1)
+        if _page != get_letter_page():
+            set_letter_page(_page)
+        _page_letters = _letters[_page * letters_per_page.value:(_page + 1) * letters_per_page.value]
+        _highlights = dict(pos=show_pos_annotations.value, lemma=show_lemma_annotations.value, part=show_part_annotations.value, structure=show_structure_annotations.value)
+        query = visualisation_query(_page_letters, **_highlights)
         print(query)
 
-        _html = store.view(query)
-        for _letter in store.query(query):
-            letter_metadata = polars.DataFrame(((x.dataset().id(), x.key().id(), str(x)) for x in _letter["letter"].data()), schema=["Dataset","Key", "Value"],orient="row")
-            break
+        mo.output.replace(mo.hstack([
+            previous_page_button,
+            mo.md(f"Page {_page + 1} of {_pagecount} ({len(_letters)} letters selected)"),
+            next_page_button
+        ], justify="center"))
+        for _dbnl_id in _page_letters:
+            _layers = []
+            for _layer in highlight_layers:
+                if _highlights[_layer]:
+                    _hits = query_cache.hits
+                    with profiler.stage("visualisation", "layer", dbnl_id=_dbnl_id, layer=_layer) as _measurements:
+                        _layers.append((_layer, letter_layer(_dbnl_id, _layer)))
+                        _measurements.update(spans=len(_layers[-1][1]), cached=query_cache.hits > _hits)
+            with profiler.stage("visualisation", "render", dbnl_id=_dbnl_id) as _measurements:
+                _html = render_letter(_dbnl_id, _layers)
+                _measurements["bytes"] = len(_html.encode("utf-8"))
+            mo.output.append(mo.Html(_html))
+        letter_metadata = letters_table.filter(polars.col("dbnl_id").is_in(_letters))
     else:
-        _html = "(no letters selected)"
+        mo.output.replace(mo.Html("(no letters selected)"))
         query = "(no query provided)"
         letter_metadata = polars.DataFrame()
-    mo.Html(_html)
     return letter_metadata, query
 
 
 @app.cell
-def __(mo, query):
+def __(mo, query, query_cache):
+    _stats = query_cache.stats()
     mo.md(f"""
 
-        The following query was used to render the above visualisation:
+        The following query is equivalent to the above page of the visualisation (which is composed from cached highlight layers per letter), you can use it as a starting point for a custom query:
 
         * ``{query}``
 
-        The table below shows all the metadata that was associated with the first selected letter:   
+        *(query result cache: {_stats['hits']} hits, {_stats['misses']} misses, {_stats['entries']} entries taking {_stats['bytes'] / 1024 / 1024:.1f} MB)*
+
+        The table below shows all the metadata that was associated with the selected letters:
     """)
     return
 
@@ -353,38 +1585,755 @@ def __(letter_metadata):
     return
 
 
+@app.cell
+def __(mo, tokens, tokens_file):
+    #this cell presents a form for corpus-wide analytics on the token table
+    _columns = [ _column for _column in tokens.collect_schema().names() if _column not in ("id","begin","end","paragraph","sentence") and not _column.endswith("confidence") ]
+    token_group_by = mo.ui.multiselect(options=_columns, value=["pos_head"], label="Count tokens by:")
+
+    mo.md(f"""
+    ## Corpus Analytics
+
+    All words in the corpus, along with their linguistic annotations and the sentence, paragraph, part and letter
+    they occur in, have been exported to a token table (``{tokens_file}``). This table can be queried with
+    [polars](https://pola.rs) for corpus-wide counts and statistics, which is a lot faster than querying the STAM model
+    for this. In the code, the table is available (lazily) in the variable `tokens`.
+
+    * {token_group_by}
+    """)
+    return token_group_by,
+
+
+@app.cell
+def __(mo, polars, time, token_group_by, tokens):
+    #this cell computes token counts for the chosen columns
+    if token_group_by.value:
+        _begintime = time.perf_counter()
+        _counts = tokens.group_by(token_group_by.value).agg(polars.len().alias("count")).sort("count", descending=True).collect()
+        _output = mo.vstack([
+            mo.ui.table(_counts, selection=None),
+            mo.md(f"*(computed in {(time.perf_counter() - _begintime) * 1000:.0f} ms)*")
+        ])
+    else:
+        _output = mo.md("(select one or more columns to count tokens by)")
+    _output
+    return
+
+
+@app.cell
+def __(
+    cache_filename,
+    letters_table,
+    os,
+    polars,
+    shared,
+    store_checksum,
+    tokens,
+    write_cache,
+):
+    #letter × feature frequencies for relating linguistic features to letter metadata: the token table is counted
+    #per letter for PoS heads, PoS classes and features and lemmas, and the result is cached in sparse (long) form,
+    #i.e. one row per letter and feature that occurs in it, along with the rate per 1000 words in that letter
+    feature_types = [ _column for _column in tokens.collect_schema().names() if _column.startswith("pos_") or _column == "lemma" ]
+    _features_file = cache_filename("features")
+    if not os.path.exists(_features_file):
+        _letter_tokens = tokens.filter(polars.col("dbnl_id").is_not_null())
+        _sizes = _letter_tokens.group_by("dbnl_id").agg(polars.len().alias("tokens"))
+        write_cache(polars.concat([
+            _letter_tokens.filter(polars.col(_column).is_not_null()).group_by("dbnl_id", _column).agg(polars.len().alias("count")).select(
+                "dbnl_id", polars.lit(_column).alias("feature_type"), polars.col(_column).alias("feature"), "count"
+            ) for _column in feature_types
+        ]).join(_sizes, on="dbnl_id").with_columns(
+            (polars.col("count") / polars.col("tokens") * 1000).alias("rate")
+        ).sort("feature_type", "feature", "dbnl_id").collect(), _features_file)
+    letter_features = shared(("letter_features", store_checksum), lambda: polars.read_parquet(_features_file))
+    #the number of words in each letter, including letters without any words
+    letter_sizes = shared(("letter_sizes", store_checksum), lambda: letters_table.select("dbnl_id").join(
+        tokens.filter(polars.col("dbnl_id").is_not_null()).group_by("dbnl_id").agg(polars.len().alias("tokens")).collect(), on="dbnl_id", how="left"
+    ).with_columns(polars.col("tokens").fill_null(0)))
+
+    def feature_matrix(feature_type, features=None, rates=False):
+        """Returns a letter × feature matrix (a column per feature) holding counts, or rates per 1000 words, joined to the letter metadata"""
+        _features = letter_features.filter(polars.col("feature_type") == feature_type)
+        if features is not None:
+            _features = _features.filter(polars.col("feature").is_in(features))
+        _matrix = _features.pivot(on="feature", index="dbnl_id", values="rate" if rates else "count")
+        _matrix = letter_sizes.join(_matrix, on="dbnl_id", how="left").fill_null(0)
+        return letters_table.join(_matrix, on="dbnl_id", how="left")
+
+    def compare_groups(feature_type, group_by, features):
+        """Compares the rate (per 1000 words) of features between groups of letters with the same metadata value"""
+        _groups = letters_table.select("dbnl_id", polars.col(group_by).cast(polars.Utf8)).join(letter_sizes, on="dbnl_id")
+        _sizes = _groups.group_by(group_by).agg(polars.len().alias("letters"), polars.col("tokens").sum())
+        _counts = letter_features.filter(
+            (polars.col("feature_type") == feature_type) & polars.col("feature").is_in(features)
+        ).join(_groups.select("dbnl_id", group_by), on="dbnl_id").group_by(group_by, "feature").agg(polars.col("count").sum())
+        #include groups in which a feature does not occur (letters without a value for group_by form a group too)
+        return _sizes.join(polars.DataFrame({ "feature": features }, schema={ "feature": polars.Utf8 }), how="cross").join(
+            _counts, on=[group_by, "feature"], how="left", join_nulls=True
+        ).with_columns(polars.col("count").fill_null(0)).with_columns(
+            (polars.col("count") / polars.col("tokens") * 1000).alias("rate")
+        ).sort(group_by, "feature", nulls_last=True)
+
+    return compare_groups, feature_matrix, feature_types, letter_features, letter_sizes
+
+
+@app.cell
+def __(feature_types, letters_table, mo):
+    #this cell presents the form for comparing features between groups of letters
+    comparison_feature_type = mo.ui.dropdown(options=feature_types, value="pos_head" if "pos_head" in feature_types else feature_types[0], label="Feature:")
+    _columns = [ _column for _column in letters_table.columns if _column != "dbnl_id" ]
+    comparison_group_by = mo.ui.dropdown(options=_columns, value="gender" if "gender" in _columns else _columns[0], label="Group letters by:")
+
+    mo.md(f"""
+    ## Sociolinguistic Comparison
+
+    Here you can compare how often linguistic features occur in letters with different metadata, for example
+    the part-of-speech tags in letters to male and female recipients. Frequencies are given as rates per 1000 words.
+    In the code, the counts per letter are available in the variable `letter_features` and can be obtained as a
+    letter × feature matrix with `feature_matrix()`.
+
+    * {comparison_feature_type}
+    * {comparison_group_by}
+    """)
+    return comparison_feature_type, comparison_group_by
+
+
+@app.cell
+def __(comparison_feature_type, letter_features, mo, polars):
+    #the most frequent features are offered for comparison
+    _features = letter_features.filter(polars.col("feature_type") == comparison_feature_type.value).group_by("feature").agg(
+        polars.col("count").sum()
+    ).sort(["count", "feature"], descending=[True, False])["feature"].to_list()
+    comparison_features = mo.ui.multiselect(options=_features[:500], value=_features[:10], label="Compare:")
+    comparison_features
+    return comparison_features,
+
+
+@app.cell
+def __(
+    alt,
+    compare_groups,
+    comparison_feature_type,
+    comparison_features,
+    comparison_group_by,
+    mo,
+    time,
+):
+    #this cell compares the chosen features between groups of letters
+    if comparison_features.value:
+        _begintime = time.perf_counter()
+        _comparison = compare_groups(comparison_feature_type.value, comparison_group_by.value, comparison_features.value)
+        _duration = time.perf_counter() - _begintime
+        _chart = alt.Chart(_comparison).mark_bar().encode(
+            x=alt.X("feature:N", title=comparison_feature_type.value, sort=comparison_features.value),
+            xOffset=alt.XOffset(f"{comparison_group_by.value}:N"),
+            y=alt.Y("rate:Q", title="rate per 1000 words"),
+            color=alt.Color(f"{comparison_group_by.value}:N"),
+            tooltip=[comparison_group_by.value, "feature", "count", "letters", "tokens", alt.Tooltip("rate:Q", format=".2f")],
+        )
+        _output = mo.vstack([
+            mo.ui.altair_chart(_chart),
+            mo.ui.table(_comparison, selection=None),
+            mo.md(f"*(computed in {_duration * 1000:.0f} ms)*"),
+        ])
+    else:
+        _output = mo.md("(select one or more features to compare)")
+    _output
+    return
+
+
+@app.cell
+def __(numpy, polars, re, shared, store, store_checksum, time, tokens):
+    #sequence search: the PoS heads, lemmas and sentences of all tokens (in text order) are encoded as integer arrays,
+    #so that a sequence pattern can be matched with vectorised array operations over the whole corpus at once,
+    #rather than with nested STAMQL queries that relate annotations one by one
+
+    class SequenceSearch:
+        """Searches token sequences by PoS head and/or lemma. A pattern consists of whitespace-separated slots:
+
+        * ``ADJ`` matches a token by PoS head, ``lemma:vreemd`` matches by lemma, ``VZ|LID`` matches any of the alternatives
+        * ``*`` matches any token
+        * a slot followed by ``?`` is optional
+        * ``{m,n}`` matches a gap of at least m and at most n arbitrary tokens
+
+        Matches do not cross sentence boundaries."""
+
+        GAP = re.compile(r"^\{(\d+),(\d+)\}$")
+
+        def __init__(self, tokens, store):
+            _tokens = tokens.select("dbnl_id", "resource", "begin", "end", "id", "sentence", "pos_head", "lemma").collect()
+            self.tokens = _tokens.select("dbnl_id", "resource", "begin", "end")
+            self.pos_heads = _tokens["pos_head"].fill_null("").to_list()
+            self.codes = {}
+            self.vocabularies = {}
+            for _column in ("pos_head", "lemma"):
+                self.vocabularies[_column] = { _value: _code for _code, _value in enumerate(_tokens[_column].drop_nulls().unique().sort()) }
+                self.codes[_column] = _tokens[_column].replace_strict(self.vocabularies[_column], default=-1, return_dtype=polars.Int32).to_numpy()
+            #tokens that are not in a sentence are treated as sentences on their own
+            self.sentences = _tokens.select(polars.col("sentence").fill_null(polars.col("id")).rank("dense")).to_series().to_numpy()
+            self.texts = { _resource.id(): _resource.text() for _resource in store.resources() }
+
+        def __len__(self):
+            return len(self.sentences)
+
+        def parse(self, pattern):
+            """Parses a pattern into a list of steps: ("slot", mask, optional) or ("gap", min, max)"""
+            _steps = []
+            for _item in pattern.split():
+                _gap = self.GAP.match(_item)
+                if _gap:
+                    _min, _max = int(_gap.group(1)), int(_gap.group(2))
+                    if _min > _max:
+                        raise ValueError(f"Invalid gap {_item}, minimum exceeds maximum")
+                    _steps.append(("gap", _min, _max))
+                    continue
+                _optional = _item.endswith("?")
+                _item = _item.rstrip("?")
+                _column, _, _values = _item.rpartition(":")
+                if _column not in ("", "lemma"):
+                    raise ValueError(f"Invalid slot {_item}, expected a PoS head, lemma:<lemma> or *")
+                if not _values:
+                    raise ValueError(f"Empty slot in pattern {pattern}")
+                if _values == "*":
+                    _mask = numpy.ones(len(self), dtype=bool)
+                else:
+                    _column = _column or "pos_head"
+                    _vocabulary = self.vocabularies[_column]
+                    _mask = numpy.isin(self.codes[_column], [ _vocabulary[_value] for _value in _values.split("|") if _value in _vocabulary ])
+                _steps.append(("slot", _mask, _optional))
+            if not _steps:
+                raise ValueError("Empty pattern")
+            return _steps
+
+        def match(self, pattern):
+            """Returns two arrays holding the index of the first and the last token of each match"""
+            _size = len(self)
+            #each candidate match is a start index and the index of the next token to consume
+            _starts = numpy.arange(_size)
+            _positions = _starts.copy()
+            for _step in self.parse(pattern):
+                if _step[0] == "gap":
+                    _candidates = [ self._advance(_starts, _positions, numpy.ones(_size, dtype=bool), _length) for _length in range(_step[1], _step[2] + 1) ]
+                else:
+                    _candidates = [ self._advance(_starts, _positions, _step[1], 1) ]
+                    if _step[2]:
+                        _candidates.append((_starts, _positions))
+                _starts = numpy.concatenate([ _candidate[0] for _candidate in _candidates ])
+                _positions = numpy.concatenate([ _candidate[1] for _candidate in _candidates ])
+                if len(_candidates) > 1:
+                    #optional slots and gaps may lead to the same candidate in multiple ways
+                    _keys = numpy.unique(_starts * (_size + 1) + _positions)
+                    _starts, _positions = _keys // (_size + 1), _keys % (_size + 1)
+            _nonempty = _positions > _starts
+            return _starts[_nonempty], _positions[_nonempty] - 1
+
+        def _advance(self, starts, positions, mask, length):
+            """Consumes `length` tokens matching `mask` for each candidate, keeps only candidates that remain in the sentence they started in"""
+            _valid = positions + length <= len(self)
+            starts, positions = starts[_valid], positions[_valid]
+            for _offset in range(length):
+                _ok = mask[positions + _offset] & (self.sentences[positions + _offset] == self.sentences[starts])
+                starts, positions = starts[_ok], positions[_ok]
+            return starts, positions + length
+
+        def search(self, pattern):
+            """Returns a table of matches with the letter, the resource offsets, the matched text and the PoS heads"""
+            _first, _last = self.match(pattern)
+            _hits = polars.DataFrame({
+                "dbnl_id": self.tokens["dbnl_id"].gather(_first),
+                "resource": self.tokens["resource"].gather(_first),
+                "begin": self.tokens["begin"].gather(_first),
+                "end": self.tokens["end"].gather(_last),
+            })
+            return _hits.with_columns(
+                polars.Series("text", [ self.texts[_resource][_begin:_end] for _resource, _begin, _end in _hits.select("resource", "begin", "end").iter_rows() ], dtype=polars.Utf8),
+                polars.Series("pos", [ " ".join(self.pos_heads[_i:_j + 1]) for _i, _j in zip(_first, _last) ], dtype=polars.Utf8),
+            )
+
+        @staticmethod
+        def to_stamql(pattern):
+            """Translates a pattern to the equivalent STAMQL query (nested PRECEDES relations), only patterns without wildcards, optional slots or gaps can be translated"""
+            _query = ""
+            _items = pattern.split()
+            for _i, _item in reversed(list(enumerate(_items))):
+                if _item == "*" or _item.endswith("?") or _item.startswith("{"):
+                    raise ValueError("Only patterns without wildcards, optional slots or gaps have a STAMQL equivalent")
+                _column, _, _values = _item.rpartition(":")
+                _data = """DATA "gustave-lem" "class" """ if _column == "lemma" else """DATA "gustave-pos" "head" """
+                _relation = f"RELATION ?t{_i} PRECEDES; " if _i else ""
+                _query = f"""SELECT ANNOTATION ?t{_i + 1} WHERE {_relation}{_data}= "{_values}";""" + (f" {{ {_query} }}" if _query else "")
+            return _query
+
+        def benchmark(self, pattern, store):
+            """Times this search against the equivalent STAMQL query, returns a dictionary with durations (s) and match counts"""
+            _begintime = time.perf_counter()
+            _matches = len(self.match(pattern)[0])
+            _results = { "sequence_search_seconds": time.perf_counter() - _begintime, "sequence_search_matches": _matches }
+            _query = self.to_stamql(pattern)
+            _begintime = time.perf_counter()
+            _matches = len(store.query(_query))
+            _results.update({ "stamql_seconds": time.perf_counter() - _begintime, "stamql_matches": _matches, "stamql_query": _query })
+            return _results
+
+    sequence_search = shared(("sequence_search", store_checksum), lambda: SequenceSearch(tokens, store))
+    return SequenceSearch, sequence_search
+
+
+@app.cell
+def __(mo):
+    #this cell presents the form for sequence search
+    sequence_pattern = mo.ui.text(label="Pattern:", placeholder="ADJ VZ LID", full_width=True)
+    sequence_benchmark_button = mo.ui.run_button(label="Compare with STAMQL")
+
+    mo.md(f"""
+    ## Sequence Search
+
+    Here you can search for sequences of words by part-of-speech and/or lemma, as in the first examples in the next
+    section, but considerably faster. A pattern consists of slots separated by spaces; a slot is a part-of-speech
+    head (e.g. ``ADJ``), a lemma (e.g. ``lemma:vreemd``), alternatives (e.g. ``VZ|LID``) or ``*`` for any word. Add a
+    ``?`` to make a slot optional, and use ``{{m,n}}`` for a gap of at least *m* and at most *n* words.
+    Matches are within a single sentence. Select matches in the table to show them in their letters.
+
+    * {sequence_pattern}
+    * {sequence_benchmark_button}
+    """)
+    return sequence_benchmark_button, sequence_pattern
+
+
+@app.cell
+def __(mo, sequence_pattern, sequence_search, time):
+    #this cell runs the sequence search
+    sequence_matches = None
+    sequence_hits = None
+    if sequence_pattern.value.strip():
+        try:
+            _begintime = time.perf_counter()
+            sequence_matches = sequence_search.search(sequence_pattern.value)
+            _duration = time.perf_counter() - _begintime
+        except ValueError as e:
+            _output = mo.md(f"❌ {e}")
+        else:
+            sequence_hits = mo.ui.table(sequence_matches, selection="multi", pagination=True)
+            _output = mo.vstack([
+                mo.md(f"{len(sequence_matches)} matches in {sequence_matches['dbnl_id'].n_unique()} letters *(found in {_duration * 1000:.0f} ms)*"),
+                sequence_hits
+            ])
+    else:
+        _output = mo.md("(enter a pattern to search for)")
+    _output
+    return sequence_hits, sequence_matches
+
+
+@app.cell
+def __(
+    annotation_span,
+    letter_index,
+    mo,
+    render_spans,
+    sequence_hits,
+    sequence_search,
+):
+    #this cell shows the selected matches in their letters
+    if sequence_hits is not None and not sequence_hits.value.is_empty():
+        _output = []
+        for (_dbnl_id,), _spans in sequence_hits.value.group_by("dbnl_id", maintain_order=True):
+            if _dbnl_id is None:
+                continue
+            _resource, _begin, _end = annotation_span(letter_index[_dbnl_id])
+            _output.append(mo.Html(render_spans(sequence_search.texts[_resource][_begin:_end], _begin, _spans.select("begin", "end").rows(), title=_dbnl_id)))
+        _output = mo.vstack(_output)
+    else:
+        _output = mo.md("(select matches in the table above to show them in their letters)")
+    _output
+    return
+
+
+@app.cell
+def __(mo, sequence_benchmark_button, sequence_pattern, sequence_search, store):
+    #this cell compares the sequence search against the equivalent STAMQL query
+    if sequence_benchmark_button.value and sequence_pattern.value.strip():
+        try:
+            _results = sequence_search.benchmark(sequence_pattern.value, store)
+        except ValueError as e:
+            _output = mo.md(f"❌ {e}")
+        else:
+            _output = mo.md(f"""
+            * Sequence search: {_results['sequence_search_matches']} matches in {_results['sequence_search_seconds'] * 1000:.1f} ms
+            * STAMQL: {_results['stamql_matches']} matches in {_results['stamql_seconds'] * 1000:.1f} ms, query: ``{_results['stamql_query']}``
+            """)
+    else:
+        _output = mo.md("")
+    _output
+    return
+
+
+@app.cell
+def __(
+    bisect,
+    cache_filename,
+    os,
+    polars,
+    re,
+    shared,
+    store_checksum,
+    tokens,
+    write_cache,
+):
+    #an inverted index over all words: the postings (one row per word occurrence) are sorted by the lower-cased word
+    #and persisted as Parquet, lookups are then binary searches in the (sorted) vocabulary rather than scans over the text
+
+    class WordIndex:
+        """Inverted index mapping words to their occurrences (letter and resource offsets). Lookups are case-insensitive."""
+
+        #spelling rules to map 17th-century orthography to a normalised (modern-like) form, applied in order
+        NORMALISATION = [ (re.compile(_pattern), _replacement) for _pattern, _replacement in (
+            (r"ck", "k"),
+            (r"gh", "g"),
+            (r"ph", "f"),
+            (r"th", "t"),
+            (r"ae", "aa"),
+            (r"y", "ij"),
+            (r"uij", "ui"),
+            (r"eij", "ei"),
+            (r"dt$", "d"),
+            (r"sch$", "s"),
+            (r"([aeou])\1(?=[bcdfgklmnprstvwz][aeiou])", r"\1"),
+        ) ]
+
+        def __init__(self, tokens, filename):
+            if not os.path.exists(filename):
+                write_cache(tokens.select(
+                    polars.col("text").str.to_lowercase().alias("term"), "dbnl_id", "resource", "begin", "end"
+                ).sort("term", "resource", "begin").collect(), filename)
+            self.postings = polars.read_parquet(filename)
+            _vocabulary = self.postings.group_by("term", maintain_order=True).len()
+            #the vocabulary is sorted, each term's postings start at offsets[i] and end at offsets[i+1]
+            self.terms = _vocabulary["term"].to_list()
+            self.offsets = [0] + _vocabulary["len"].cum_sum().to_list()
+            self.normalised = {}
+            for _i, _term in enumerate(self.terms):
+                self.normalised.setdefault(self.normalise(_term), []).append(_i)
+
+        @classmethod
+        def normalise(cls, word):
+            """Returns the normalised spelling of a word"""
+            word = word.lower()
+            for _pattern, _replacement in cls.NORMALISATION:
+                word = _pattern.sub(_replacement, word)
+            return word
+
+        def _postings(self, indices):
+            """Returns the postings for the terms with the given vocabulary indices"""
+            _slices = [ self.postings.slice(self.offsets[_i], self.offsets[_i + 1] - self.offsets[_i]) for _i in indices ]
+            return polars.concat(_slices) if _slices else self.postings.clear()
+
+        def exact(self, word):
+            word = word.lower()
+            _i = bisect.bisect_left(self.terms, word)
+            return self._postings([_i] if _i < len(self.terms) and self.terms[_i] == word else [])
+
+        def prefix(self, prefix):
+            prefix = prefix.lower()
+            return self._postings(range(bisect.bisect_left(self.terms, prefix), bisect.bisect_left(self.terms, prefix + "\U0010ffff")))
+
+        def regex(self, pattern):
+            """Returns the postings of all words that match the regular expression in full"""
+            _pattern = re.compile(pattern, re.IGNORECASE)
+            return self._postings([ _i for _i, _term in enumerate(self.terms) if _pattern.fullmatch(_term) ])
+
+        def variants(self, word):
+            """Returns the postings of all words that have the same normalised spelling (e.g. vlieghen and vliegen)"""
+            return self._postings(self.normalised.get(self.normalise(word), []))
+
+        def search(self, query, mode="exact"):
+            """Searches for a word, mode is one of: exact, prefix, regex, variants"""
+            return { "exact": self.exact, "prefix": self.prefix, "regex": self.regex, "variants": self.variants }[mode](query)
+
+    word_index = shared(("word_index", store_checksum), lambda: WordIndex(tokens, cache_filename("wordindex")))
+    return WordIndex, word_index
+
+
+@app.cell
+def __(mo):
+    #this cell presents the form for word search
+    word_query = mo.ui.text(label="Word:", placeholder="vlieghen", full_width=True)
+    word_search_mode = mo.ui.dropdown(options={
+        "exact word": "exact",
+        "words starting with": "prefix",
+        "regular expression": "regex",
+        "spelling variants": "variants",
+    }, value="spelling variants", label="Find:")
+
+    mo.md(f"""
+    ## Word Search
+
+    Here you can quickly find all occurrences of a word in all letters, using an index rather than the ``TEXT`` queries
+    shown in the examples below. Searching is case-insensitive. As spelling was not standardised in the 17th
+    century, you can also search for spelling variants (for example *vlieghen* also finds *vliegen* and *Naerden*
+    also finds *Naarden*), these are found by comparing words after normalising common spelling differences
+    (*ae*→*aa*, *gh*→*g*, *y*→*ij*, *ck*→*k*, etc.).
+
+    * {word_search_mode} {word_query}
+    """)
+    return word_query, word_search_mode
+
+
+@app.cell
+def __(mo, re, time, word_index, word_query, word_search_mode):
+    #this cell runs the word search
+    word_hits = None
+    if word_query.value.strip():
+        _begintime = time.perf_counter()
+        try:
+            word_hits = word_index.search(word_query.value.strip(), word_search_mode.value)
+        except re.error as e:
+            _output = mo.md(f"❌ Invalid regular expression: {e}")
+        else:
+            _output = mo.vstack([
+                mo.md(f"{len(word_hits)} occurrences of {word_hits['term'].n_unique()} distinct words in {word_hits['dbnl_id'].n_unique()} letters *(found in {(time.perf_counter() - _begintime) * 1000:.0f} ms)*"),
+                mo.hstack([
+                    mo.ui.table(word_hits.group_by("term").len().sort("len", "term", descending=[True, False]).rename({ "len": "occurrences" }), selection=None),
+                    mo.ui.table(word_hits, selection=None),
+                ], widths=[1, 3]),
+            ])
+    else:
+        _output = mo.md("(enter a word to search for)")
+    _output
+    return word_hits,
+
+
+@app.cell
+def __(numpy, polars, shared, store, store_checksum, tokens):
+    #keyword-in-context: rather than rendering whole letters, the context of many hits is retrieved at once by
+    #locating all hits in the (sorted) token arrays and slicing the left and right context windows from them
+
+    class Concordance:
+        """Produces keyword-in-context tables for hits, i.e. tables with resource, begin and end columns"""
+
+        def __init__(self, tokens, store):
+            _tokens = tokens.select("dbnl_id", "resource", "begin", "end", "pos_head", "lemma").with_columns(
+                polars.int_range(polars.len()).alias("index")
+            ).collect()
+            self.resources = { _resource: _code for _code, _resource in enumerate(_tokens["resource"].unique(maintain_order=True)) }
+            _resource_codes = _tokens["resource"].replace_strict(self.resources, return_dtype=polars.Int64).to_numpy()
+            #tokens are sorted by resource and offset, so these keys are sorted as well
+            self.begin_keys = (_resource_codes << 32) + _tokens["begin"].to_numpy().astype(numpy.int64)
+            self.end_keys = (_resource_codes << 32) + _tokens["end"].to_numpy().astype(numpy.int64)
+            self.begins = _tokens["begin"].to_list()
+            self.ends = _tokens["end"].to_list()
+            self.pos_heads = _tokens["pos_head"].fill_null("?").to_list()
+            self.lemmas = _tokens["lemma"].fill_null("?").to_list()
+            #for each token, the index of the first and last token of the letter (or the run of tokens outside any letter) it is in
+            _letters = _tokens.select(
+                polars.col("index").first().over(polars.col("dbnl_id").rle_id()).alias("first"),
+                polars.col("index").last().over(polars.col("dbnl_id").rle_id()).alias("last"),
+            )
+            self.letter_first = _letters["first"].to_numpy()
+            self.letter_last = _letters["last"].to_numpy()
+            self.texts = { _resource.id(): _resource.text() for _resource in store.resources() }
+
+        def locate(self, hits):
+            """Returns two arrays with the index of the first and last token of each hit"""
+            _codes = hits["resource"].replace_strict(self.resources, default=-1, return_dtype=polars.Int64).to_numpy()
+            _first = numpy.searchsorted(self.begin_keys, (_codes << 32) + hits["begin"].to_numpy().astype(numpy.int64), side="right") - 1
+            _last = numpy.searchsorted(self.end_keys, (_codes << 32) + hits["end"].to_numpy().astype(numpy.int64), side="left")
+            return numpy.clip(_first, 0, len(self.begins) - 1), numpy.clip(_last, 0, len(self.ends) - 1)
+
+        def table(self, hits, context=5):
+            """Returns a table with the left context, hit and right context (at most `context` words, within the same
+            letter) of each hit, along with the PoS heads and lemmas of the words in the hit"""
+            _first, _last = self.locate(hits)
+            _left = numpy.maximum(_first - context, self.letter_first[_first])
+            _right = numpy.minimum(_last + context, self.letter_last[_last])
+            _columns = { "left": [], "hit": [], "right": [], "pos": [], "lemma": [], "right_pos": [] }
+            for _resource, _begin, _end, _i, _j, _l, _r in zip(hits["resource"], hits["begin"], hits["end"], _first, _last, _left, _right):
+                _text = self.texts[_resource]
+                _columns["left"].append(" ".join(_text[self.begins[_l]:_begin].split()) if _l < _i else "")
+                _columns["hit"].append(" ".join(_text[_begin:_end].split()))
+                _columns["right"].append(" ".join(_text[_end:self.ends[_r]].split()) if _r > _j else "")
+                _columns["pos"].append(" ".join(self.pos_heads[_i:_j + 1]))
+                _columns["lemma"].append(" ".join(self.lemmas[_i:_j + 1]))
+                _columns["right_pos"].append(" ".join(self.pos_heads[_j + 1:_r + 1]))
+            return hits.select("dbnl_id", "resource", "begin", "end").with_columns(
+                polars.Series(_column, _values, dtype=polars.Utf8) for _column, _values in _columns.items()
+            ).select("dbnl_id", "left", "hit", "right", "pos", "lemma", "right_pos", "resource", "begin", "end")
+
+    concordance = shared(("concordance", store_checksum), lambda: Concordance(tokens, store))
+    return Concordance, concordance
+
+
+@app.cell
+def __(mo):
+    #this cell presents the form for the concordance
+    concordance_source = mo.ui.dropdown(options=["word search", "sequence search"], value="word search", label="Show the hits of:")
+    concordance_context = mo.ui.number(start=1, stop=25, step=1, value=5, label="Context (words):")
+
+    mo.md(f"""
+    ## Concordance
+
+    The hits of the word search or sequence search above can be shown as a concordance (keyword in context), with
+    the words to the left and right of each hit and the part-of-speech and lemma of the words in the hit. The table
+    can be sorted by any column, e.g. by *right* or *right_pos* to group similar contexts.
+
+    * {concordance_source} {concordance_context}
+    """)
+    return concordance_context, concordance_source
+
+
+@app.cell
+def __(
+    concordance,
+    concordance_context,
+    concordance_source,
+    mo,
+    sequence_matches,
+    time,
+    word_hits,
+):
+    #this cell shows the concordance
+    _hits = word_hits if concordance_source.value == "word search" else sequence_matches
+    if _hits is not None and not _hits.is_empty():
+        _begintime = time.perf_counter()
+        _table = concordance.table(_hits, concordance_context.value)
+        _output = mo.vstack([
+            mo.md(f"*({len(_table)} hits, computed in {(time.perf_counter() - _begintime) * 1000:.0f} ms)*"),
+            mo.ui.table(_table, selection=None, pagination=True, page_size=25),
+        ])
+    else:
+        _output = mo.md(f"(no hits, search something in the {concordance_source.value} first)")
+    _output
+    return
+
+
 @app.cell
 def __(mo, store):
     #this cell produces the custom query form
     mo.stop(store is None)
     queryform = mo.ui.text_area(label="Enter a query. Subqueries can be used to specify highlights. Use [STAMQL syntax](https://github.com/annotation/stam/tree/master/extensions/stam-query):",full_width=True, rows=25).form()
+    query_timeout = mo.ui.number(start=1, stop=3600, value=60)
+    query_explain = mo.ui.switch(label="Explain: also evaluate the query constraint by constraint to show where the candidates and the time go (slower)")
+
+    #the running custom query job, so it can be cancelled
+    active_custom_query = { "job": None }
+
+    def _cancel(clicks):
+        if active_custom_query["job"] is not None:
+            active_custom_query["job"].cancel()
+        return clicks + 1
+
+    cancel_query_button = mo.ui.button(label="cancel query", value=0, on_click=_cancel)
+    query_refresh = mo.ui.refresh(default_interval="1s")
 
     mo.md(f"""
     ## Custom Queries
 
     {queryform}
+
+    * Cancel queries that take longer than {query_timeout} seconds
+    * {query_explain}
     """)
-    return queryform,
+    return (
+        active_custom_query,
+        cancel_query_button,
+        query_explain,
+        query_refresh,
+        query_timeout,
+        queryform,
+    )
 
 
 @app.cell
-def __(mo, queryform, store):
-    #this cell runs the custom query and presents the results
-
+def __(
+    QueryJob,
+    active_custom_query,
+    diagnostics_switch,
+    explain_query,
+    query_cache,
+    query_explain,
+    query_timeout,
+    queryform,
+    store,
+    store_snapshot,
+):
+    #this cell submits the custom query to a worker, unless the results are cached already (and no explanation is asked)
+    if active_custom_query["job"] is not None:
+        #a new submission supersedes any query that is still running
+        active_custom_query["job"].cancel()
     if queryform.value:
-        _html = store.view(queryform.value)
-        if _html.find("<h2>") == -1:
-            _html = "(custom query did no produce any results)"
+        _html = None if query_explain.value else query_cache.lookup(query_cache.view_key(queryform.value))
+        if _html is None:
+            custom_query_job = QueryJob(store, query_cache.normalize(queryform.value), timeout=query_timeout.value, profile=diagnostics_switch.value,
+                                        explain=explain_query if query_explain.value else None, snapshot=store_snapshot)
+        else:
+            custom_query_job = QueryJob.finished(queryform.value, _html)
+    else:
+        custom_query_job = None
+    active_custom_query["job"] = custom_query_job
+    return custom_query_job,
+
+
+@app.cell
+def __(
+    cancel_query_button,
+    custom_query_job,
+    mo,
+    polars,
+    profiler,
+    query_cache,
+    query_refresh,
+):
+    #this cell presents the results of the custom query, or its progress as long as it is running
+    #(the refresh element re-runs this cell every second for as long as it is shown)
+    cancel_query_button.value
+    if custom_query_job is not None and custom_query_job.status != "running" and not custom_query_job.reported:
+        custom_query_job.reported = True
+        profiler.record("custom query", "job", custom_query_job.elapsed(), status=custom_query_job.status,
+                        bytes=len(custom_query_job.html.encode("utf-8")) if custom_query_job.html else None, **custom_query_job.stats)
+    if custom_query_job is None:
+        _output = mo.Html("(no custom query submitted)")
+    elif custom_query_job.status == "running":
+        _output = mo.hstack([
+            mo.md(f"⏳ Query running for {custom_query_job.elapsed():.0f}s (cancelled after {custom_query_job.timeout}s)"),
+            cancel_query_button,
+            query_refresh
+        ], justify="start")
+    elif custom_query_job.status == "done":
+        query_cache.add(query_cache.view_key(custom_query_job.query), custom_query_job.html, len(custom_query_job.html.encode("utf-8")))
+        if custom_query_job.html.find("<h2>") == -1:
+            _output = mo.Html("(custom query did no produce any results)")
+        else:
+            _output = mo.Html(custom_query_job.html)
+        if custom_query_job.explanation:
+            #the explanation is shown as a table next to the results
+            _explanation = custom_query_job.explanation
+            _levels = ", ".join(f"{_level['level']} ({_level['variable']}): {_level['seconds'] * 1000:.0f} ms" for _level in _explanation["levels"])
+            _suggestions = "".join(f"\n* 💡 {_suggestion}" for _suggestion in _explanation["suggestions"]) or "\n* No reordering of constraints suggested"
+            _output = mo.hstack([
+                _output,
+                mo.vstack([
+                    mo.md(f"**Explanation**: {_explanation['results'] if _explanation['results'] is not None else 'uncounted'} results in {_explanation['seconds'] * 1000:.0f} ms. "
+                          f"Time per subquery level: {_levels}.{_suggestions}\n\n"
+                          "The candidates are the distinct values of the variable of the level that remain after the constraints up to and "
+                          "including the one in the row, or with only that constraint (the constraints relating a level to the enclosing "
+                          "query are always included). The seconds are the time it took to evaluate up to and including the constraint:"),
+                    mo.ui.table(polars.from_dicts(_explanation["clauses"], infer_schema_length=None), selection=None, pagination=True, page_size=25),
+                ]),
+            ], widths=[1, 1], align="start")
+    elif custom_query_job.status == "timeout":
+        _output = mo.md(f"❌ Query exceeded {custom_query_job.timeout}s and was cancelled, try a more constrained query or a higher timeout.")
+    elif custom_query_job.status == "cancelled":
+        _output = mo.md(f"Query was cancelled after {custom_query_job.elapsed():.0f}s")
     else:
-        _html = "(no custom query submitted)"
-    mo.Html(_html)
+        _output = mo.md(f"❌ Query failed: ``{custom_query_job.error}``")
+    _output
     return
 
 
 @app.cell
-def __(mo, store):
+def __(mo, re, store):
     mo.stop(store is None)
-    mo.md(
+    _examples = (
         r"""
         ## Custom Query Examples
 
@@ -418,7 +2367,6 @@ def __(mo, store):
                 RELATION ?letter EMBEDS;
                 DATA "gustave-pos" "head" = "BW";
             }
-            }
         ```
 
         ### Search for words with a specific text
@@ -517,6 +2465,7 @@ def __(mo, store):
            }
          }
         }
+        ```
 
         ### Search for a specific part annotation 
 
@@ -529,8 +2478,391 @@ def __(mo, store):
 
         """
     )
+
+    #the example queries by title (these are also used by the benchmark)
+    example_queries = {}
+    _title = None
+    for _match in re.finditer(r"^ *### ([^\n]*)$|^ *```\n(.*?)^ *```", _examples, re.MULTILINE | re.DOTALL):
+        if _match.group(1):
+            _title = _match.group(1).strip()
+        else:
+            _name = _title if _title not in example_queries else f"{_title} ({sum(_key.startswith(_title) for _key in example_queries) + 1})"
+            example_queries[_name] = _match.group(2).strip()
+
+    mo.md(_examples)
+    return example_queries,
+
+
+@app.cell
+def __(mo):
+    #this cell presents the diagnostics section
+    diagnostics_switch = mo.ui.switch(label="Measure custom query evaluation separately (slower)")
+    diagnostics_refresh = mo.ui.button(label="Refresh", value=0, on_click=lambda clicks: clicks + 1)
+
+    mo.md(f"""
+    ## Diagnostics
+
+    This section shows how long the various stages of loading the data, visualising letters and running custom
+    queries took, along with the size of the produced HTML and the memory use of the notebook process afterwards.
+    For the letter visualisation, the time to obtain each highlight layer and to render each letter is shown.
+    If the switch below is enabled, custom queries are also evaluated separately from rendering their results,
+    so query time and result count are shown apart from the view time (at the cost of evaluating each query twice).
+
+    * {diagnostics_switch}
+    * {diagnostics_refresh}
+    """)
+    return diagnostics_refresh, diagnostics_switch
+
+
+@app.cell
+def __(diagnostics_refresh, mo, polars, profiler):
+    #this cell shows the diagnostics collected so far
+    diagnostics_refresh.value
+    _records = profiler.table()
+    if _records.is_empty():
+        _output = mo.md("(nothing measured yet)")
+    else:
+        _summary = _records.group_by("cell", "stage", maintain_order=True).agg(
+            polars.len().alias("count"),
+            polars.col("seconds").sum().alias("total_seconds"),
+            polars.col("seconds").mean().alias("mean_seconds"),
+            polars.col("seconds").max().alias("max_seconds"),
+        )
+        _rss = profiler.rss_kb()
+        _output = mo.vstack([
+            mo.md(f"Current process memory (RSS): {_rss / 1024:.0f} MB" if _rss is not None else "Current process memory (RSS): unknown"),
+            mo.ui.table(_summary, selection=None),
+            mo.ui.table(_records.drop("timestamp"), selection=None, pagination=True),
+            mo.download(data=profiler.export().encode("utf-8"), filename="brieven-van-hooft-diagnostics.json", mimetype="application/json", label="Export as JSON"),
+        ])
+    _output
     return
 
 
+@app.cell
+def __(
+    Profiler,
+    example_queries,
+    highlight_layers,
+    itertools,
+    json,
+    letter_index,
+    letter_layer,
+    multiprocessing,
+    natsorted,
+    os,
+    render_letter,
+    stam,
+    store,
+    store_checksum,
+    threading,
+    time,
+):
+    #a headless benchmark of the example queries and the letter visualisation, run it with:
+    #  python brieven-van-hooft-notebook.py benchmark [--letters N] [--repeat N] [--output FILE] [--baseline FILE]
+
+    def benchmark_queries(letters=5):
+        """Returns the queries to benchmark by name: all examples and the visualisation of the first letters with every
+        combination of highlights. The visualisation is measured as the notebook does it (computing the highlight layers
+        of each letter, uncached, and rendering it), so these are functions returning the HTML of a letter."""
+        _queries = { f"example: {_title}": _query for _title, _query in example_queries.items() }
+
+        def _visualise(dbnl_id, layers):
+            return lambda: render_letter(dbnl_id, [ (_layer, letter_layer(dbnl_id, _layer, cached=False)) for _layer in layers ])
+
+        for _enabled in itertools.product((False, True), repeat=len(highlight_layers)):
+            _layers = [ _layer for _layer, _value in zip(highlight_layers, _enabled) if _value ]
+            _queries[f"visualisation: {'+'.join(_layers) or 'none'}"] = [ _visualise(_dbnl_id, _layers) for _dbnl_id in natsorted(letter_index)[:letters] ]
+        return _queries
+
+    def _measure(queries, repeat):
+        """Runs the queries (uncached) through store.view() `repeat` times, returns the fastest wall time and the output size.
+        A query may also be a function that returns the output."""
+        _result = { "seconds": None, "output_bytes": None, "error": None }
+        try:
+            for _ in range(repeat):
+                _begintime = time.perf_counter()
+                _size = sum(len((_query() if callable(_query) else store.view(_query)).encode("utf-8")) for _query in queries)
+                _seconds = time.perf_counter() - _begintime
+                _result["seconds"] = _seconds if _result["seconds"] is None else min(_result["seconds"], _seconds)
+            _result["output_bytes"] = _size
+        except stam.StamError as e:
+            _result["error"] = str(e)
+        return _result
+
+    def _measure_forked(queries, repeat):
+        """Measures the queries in a forked child process, the rise of the child's peak memory (`peak_rss_kb`) above
+        its memory at the start tells how much memory the queries took (`memory_kb`)"""
+        _receiver, _sender = multiprocessing.Pipe(duplex=False)
+        _pid = os.fork()
+        if _pid == 0:
+            #this runs in the child process, its resident memory at the start is the baseline
+            _rss_kb = Profiler.rss_kb()
+            try:
+                _result = _measure(queries, repeat)
+            except BaseException as e:
+                _result = { "seconds": None, "output_bytes": None, "error": f"{type(e).__name__}: {e}" }
+            _result["rss_kb"] = _rss_kb
+            _sender.send(_result)
+            os._exit(0)
+        _sender.close()
+        try:
+            _result = _receiver.recv()
+        except EOFError:
+            _result = { "seconds": None, "output_bytes": None, "error": "benchmark process died", "rss_kb": None }
+        _receiver.close()
+        _, _, _usage = os.wait4(_pid, 0)
+        _rss_kb = _result.pop("rss_kb")
+        _result["peak_rss_kb"] = _usage.ru_maxrss
+        _result["memory_kb"] = max(_usage.ru_maxrss - _rss_kb, 0) if _rss_kb is not None else None
+        return _result
+
+    def run_benchmark(queries, repeat=1):
+        """Runs the queries (uncached) through store.view(), a query may also be a function returning the output, or a list
+        of queries that are timed together.
+        Returns a list of results with the (fastest) wall time, output size and the memory each query took (`memory_kb`).
+        Each query runs in a forked process where possible, otherwise the memory is the growth of this process."""
+        _results = []
+        for _name, _queries in queries.items():
+            if isinstance(_queries, str) or callable(_queries):
+                _queries = [_queries]
+            _result = { "name": _name, "queries": len(_queries) }
+            #like the query workers, only fork when no other threads are running
+            if hasattr(os, "fork") and hasattr(os, "wait4") and threading.active_count() == 1:
+                _result.update(_measure_forked(_queries, repeat))
+            else:
+                _rss_kb = Profiler.rss_kb()
+                _result.update(_measure(_queries, repeat))
+                _result["peak_rss_kb"] = None
+                _result["memory_kb"] = max(Profiler.rss_kb() - _rss_kb, 0) if _rss_kb is not None else None
+            _results.append(_result)
+        return { "stam_version": stam.VERSION, "store_checksum": store_checksum, "repeat": repeat, "results": _results }
+
+    def compare_benchmark(benchmark, baseline, tolerance=0.25, min_difference=0.01, min_memory_kb=10240):
+        """Compares benchmark results with a baseline, returns a list of regressions (descriptions), i.e. queries
+        that became more than `tolerance` (fraction) and `min_difference` seconds slower, that take more than `tolerance`
+        and `min_memory_kb` more memory, that produce different output or that now fail"""
+        _regressions = []
+        _baseline = { _result["name"]: _result for _result in baseline["results"] }
+        for _result in benchmark["results"]:
+            _previous = _baseline.get(_result["name"])
+            if _previous is None:
+                continue
+            if _result["error"] and not _previous["error"]:
+                _regressions.append(f"{_result['name']}: fails ({_result['error'].splitlines()[0]})")
+            elif _result["seconds"] is not None and _previous["seconds"] is not None and _result["seconds"] > max(_previous["seconds"] * (1 + tolerance), _previous["seconds"] + min_difference):
+                _regressions.append(f"{_result['name']}: {_previous['seconds']:.3f}s -> {_result['seconds']:.3f}s")
+            elif not _result["error"] and not _previous["error"] and _result["output_bytes"] != _previous["output_bytes"]:
+                _regressions.append(f"{_result['name']}: output size {_previous['output_bytes']} -> {_result['output_bytes']} bytes")
+            if _result.get("memory_kb") is not None and _previous.get("memory_kb") is not None and _result["memory_kb"] > max(_previous["memory_kb"] * (1 + tolerance), _previous["memory_kb"] + min_memory_kb):
+                _regressions.append(f"{_result['name']}: memory {_previous['memory_kb']} -> {_result['memory_kb']} kB")
+        return _regressions
+
+    def benchmark_main(args):
+        """Entry point for the command line benchmark, returns the exit code"""
+        _benchmark = run_benchmark(benchmark_queries(args.letters), args.repeat)
+        for _result in _benchmark["results"]:
+            if _result["error"]:
+                print(f"{_result['name']:<60} ERROR: {_result['error'].splitlines()[0]}")
+            else:
+                print(f"{_result['name']:<60} {_result['seconds']:8.3f}s {_result['output_bytes']:>12} bytes {_result['memory_kb'] or 0:>10} kB")
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(_benchmark, f, indent=4)
+        if args.baseline:
+            with open(args.baseline, "r", encoding="utf-8") as f:
+                _baseline = json.load(f)
+            if (_baseline["stam_version"], _baseline["store_checksum"]) != (_benchmark["stam_version"], _benchmark["store_checksum"]):
+                print(f"Note: baseline was made with stam {_baseline['stam_version']} and store {_baseline['store_checksum'][:16]}")
+            _regressions = compare_benchmark(_benchmark, _baseline, args.tolerance)
+            for _regression in _regressions:
+                print(f"REGRESSION {_regression}")
+            return 1 if _regressions else 0
+        return 0
+
+    return benchmark_main, benchmark_queries, compare_benchmark, run_benchmark
+
+
+@app.cell
+def __(json, multiprocessing, polars, stam, store, time):
+    #a headless batch runner for many queries, run it with:
+    #  python brieven-van-hooft-notebook.py batch [QUERYFILE] [--workers N] [--format jsonl|parquet] [--output FILE]
+    #the queries are distributed over forked worker processes, which all share the loaded store copy-on-write
+
+    def read_batch_queries(f):
+        """Reads queries from a file: either JSON lines with an id and a query, or plain queries separated by empty lines.
+        Returns a list of (id, query) tuples"""
+        _text = f.read()
+        if _text.lstrip().startswith("{"):
+            _queries = [ json.loads(_line) for _line in _text.splitlines() if _line.strip() ]
+            return [ (str(_query.get("id", _i + 1)), _query["query"]) for _i, _query in enumerate(_queries) ]
+        _queries = [ _query.strip() for _query in _text.replace("\r\n", "\n").split("\n\n") if _query.strip() ]
+        return [ (str(_i + 1), _query) for _i, _query in enumerate(_queries) ]
+
+    def serialize_result(value):
+        """Returns a JSON-serialisable dictionary for a value in a query result"""
+        _result = { "type": type(value).__name__ }
+        if isinstance(value, stam.TextSelection):
+            _result.update(resource=value.resource().id(), begin=value.begin(), end=value.end(), text=str(value))
+        elif isinstance(value, stam.AnnotationData):
+            _result.update(set=value.dataset().id(), key=value.key().id(), value=value.value().get())
+        else:
+            _result["id"] = value.id()
+        return _result
+
+    def run_batch_query(index, query_id, query):
+        """Runs a single query on the store, returns a record with its results and timing"""
+        _record = { "index": index, "id": query_id, "query": query, "seconds": None, "count": None, "results": None, "error": None }
+        _begintime = time.perf_counter()
+        try:
+            _results = store.query(query)
+            _record["results"] = [ { _variable: serialize_result(_value) for _variable, _value in _row.items() } for _row in _results ]
+            _record["count"] = len(_results)
+        except Exception as e:
+            #any failure is reported in the record, so one query can not bring down the whole batch
+            _record["error"] = str(e) if isinstance(e, stam.StamError) else f"{type(e).__name__}: {e}"
+        _record["seconds"] = time.perf_counter() - _begintime
+        return _record
+
+    def run_batch(queries, workers=None):
+        """Runs (id, query) tuples and yields result records in order of completion. With `workers` > 1 (default: the
+        number of cores), the queries are run by forked worker processes, otherwise (or where fork is not available)
+        they are run one by one in this process"""
+        workers = min(workers or multiprocessing.cpu_count(), len(queries))
+        if workers <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+            for _index, (_id, _query) in enumerate(queries):
+                yield run_batch_query(_index, _id, _query)
+            return
+        _context = multiprocessing.get_context("fork")
+        #the workers take the next query from a shared counter, and keep the index of the query they are running
+        #(or -1) in shared memory, so it is known which query a worker was running if it dies
+        _next = _context.Value("q", 0)
+        _current = _context.Array("q", [-1] * workers)
+
+        def _work(worker, connection):
+            #this runs in the worker processes, results are sent through a pipe right away (not buffered as by a queue)
+            while True:
+                with _next.get_lock():
+                    _index = _current[worker] = _next.value
+                    _next.value += 1
+                if _index >= len(queries):
+                    break
+                connection.send(run_batch_query(_index, *queries[_index]))
+            connection.close()
+
+        def _failed(index, error):
+            _id, _query = queries[index]
+            return { "index": index, "id": _id, "query": _query, "seconds": None, "count": None, "results": None, "error": error }
+
+        _processes = []
+        #the receiving end of the pipe of each worker
+        _receivers = {}
+        for _worker in range(workers):
+            _receiver, _sender = _context.Pipe(duplex=False)
+            _processes.append(_context.Process(target=_work, args=(_worker, _sender), daemon=True))
+            _processes[-1].start()
+            #closed right away, so that the pipe reports the end once the worker is gone (and later workers do not inherit it)
+            _sender.close()
+            _receivers[_receiver] = _worker
+        _pending = set(range(len(queries)))
+        try:
+            while _receivers:
+                for _receiver in multiprocessing.connection.wait(list(_receivers)):
+                    try:
+                        _record = _receiver.recv()
+                    except EOFError:
+                        #the worker is gone: either it is done, or it died (e.g. on a panic in stam or killed for lack of memory)
+                        _worker = _receivers.pop(_receiver)
+                        _processes[_worker].join()
+                        if _current[_worker] in _pending:
+                            _pending.discard(_current[_worker])
+                            yield _failed(_current[_worker], f"worker process died (exit code {_processes[_worker].exitcode})")
+                        continue
+                    _pending.discard(_record["index"])
+                    yield _record
+            for _index in sorted(_pending):
+                yield _failed(_index, "not run, the worker processes died")
+        finally:
+            for _process in _processes:
+                _process.kill()
+                _process.join()
+
+    def batch_table(records):
+        """Flattens result records to a table with one row per variable in each result (queries without results get a single row)"""
+        _rows = []
+        for _record in records:
+            _query = { _key: _record[_key] for _key in ("index", "id", "query", "seconds", "count", "error") }
+            if not _record["results"]:
+                _rows.append(_query)
+            for _i, _result in enumerate(_record["results"] or []):
+                for _variable, _value in _result.items():
+                    #the fields of the result are prefixed, so they do not clash with those of the query (e.g. its id)
+                    _rows.append({ **_query, "result": _i, "variable": _variable, **{ f"result_{_key}": str(_v) if _key == "value" else _v for _key, _v in _value.items() } })
+        return polars.from_dicts(_rows, infer_schema_length=None).sort("index", maintain_order=True)
+
+    def batch_main(args):
+        """Entry point for the command line batch runner, returns the exit code"""
+        import sys
+        if args.queries in (None, "-"):
+            _queries = read_batch_queries(sys.stdin)
+        else:
+            with open(args.queries, "r", encoding="utf-8") as f:
+                _queries = read_batch_queries(f)
+        _begintime = time.perf_counter()
+        _failed = 0
+        if args.format == "jsonl":
+            _out = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+            try:
+                for _record in run_batch(_queries, args.workers):
+                    _failed += _record["error"] is not None
+                    _out.write(json.dumps(_record, default=str) + "\n")
+                    _out.flush()
+            finally:
+                if _out is not sys.stdout:
+                    _out.close()
+        else:
+            if not args.output:
+                print("Parquet output requires --output", file=sys.stderr)
+                return 2
+            _records = list(run_batch(_queries, args.workers))
+            _failed = sum(_record["error"] is not None for _record in _records)
+            batch_table(_records).write_parquet(args.output)
+        print(f"Ran {len(_queries)} queries in {time.perf_counter() - _begintime:.1f}s, {_failed} failed", file=sys.stderr)
+        return 1 if _failed else 0
+
+    return batch_main, batch_table, read_batch_queries, run_batch, run_batch_query, serialize_result
+
+
 if __name__ == "__main__":
+    import argparse
+    import sys
+    if sys.argv[1:2] in (["benchmark"], ["batch"]):
+        _parser = argparse.ArgumentParser(prog=sys.argv[0], description="Runs the notebook headless for benchmarking or batch queries")
+        _commands = _parser.add_subparsers(dest="command")
+        _benchmark = _commands.add_parser("benchmark", description="Benchmarks the example queries and letter visualisation queries")
+        _benchmark.add_argument("--letters", type=int, default=5, help="Number of letters to visualise")
+        _benchmark.add_argument("--repeat", type=int, default=1, help="Number of times to run each query, the fastest run counts")
+        _benchmark.add_argument("--output", help="Write the results (JSON) to this file")
+        _benchmark.add_argument("--baseline", help="Compare the results against a baseline (results written earlier with --output)")
+        _benchmark.add_argument("--tolerance", type=float, default=0.25, help="Fraction a query may be slower than the baseline before it is reported")
+        _batch = _commands.add_parser("batch", description="Runs many queries and outputs their results")
+        _batch.add_argument("queries", nargs="?", help="File with queries separated by empty lines, or JSON lines with an id and a query (default: standard input)")
+        _batch.add_argument("--workers", type=int, help="Number of worker processes (default: number of cores)")
+        _batch.add_argument("--format", choices=("jsonl", "parquet"), default="jsonl", help="Output format")
+        _batch.add_argument("--output", help="Write the results to this file (default for jsonl: standard output)")
+        _args = _parser.parse_args()
+        _, _defs = app.run()
+        sys.exit(_defs[f"{_args.command}_main"](_args))
+    elif sys.argv[1:2] == ["worker"]:
+        #a query worker (see QueryWorker), it reads queries from standard input and writes their outcome to standard output
+        import os
+        import stam
+        _, _defs = query_jobs.run()
+        _, _explanation = query_explanation.run()
+        _responses = os.fdopen(os.dup(1), "w", encoding="utf-8")
+        #anything else written to standard output must not end up between the responses
+        os.dup2(2, 1)
+        sys.stdin.reconfigure(encoding="utf-8")
+        _defs["QueryWorker"].serve(stam.AnnotationStore(file=sys.argv[2]), _explanation["explain_query"], sys.stdin, _responses)
+        sys.exit(0)
     app.run()
@@ -0,0 +1,108 @@
+"""Tests the downloader against a local stand-in for the data servers"""
+import hashlib
+import http.server
+import importlib.util
+import os.path
+import threading
+
+import pytest
+
+NOTEBOOK = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "brieven-van-hooft-notebook.py")
+DATA = bytes(range(256)) * 4096
+
+
+@pytest.fixture(scope="module")
+def data_files():
+    spec = importlib.util.spec_from_file_location("brieven_van_hooft_notebook", NOTEBOOK)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.data_files.run()[1]
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """Serves DATA, honouring Range requests unless the server is told to ignore them,
+    and cutting off the first `truncate` responses halfway"""
+
+    def do_GET(self):
+        self.server.ranges.append(self.headers.get("Range"))
+        offset = 0
+        if self.headers.get("Range") and not self.server.ignore_range:
+            offset = int(self.headers["Range"].removeprefix("bytes=").rstrip("-"))
+            if offset >= len(DATA):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(DATA)}")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {offset}-{len(DATA) - 1}/{len(DATA)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(DATA) - offset))
+        self.end_headers()
+        if self.server.truncate > 0:
+            self.server.truncate -= 1
+            self.wfile.write(DATA[offset:offset + (len(DATA) - offset) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(DATA[offset:])
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.ranges = []
+    server.ignore_range = False
+    server.truncate = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def fetch(data_files, server, filename):
+    digest = data_files["fetch_file"](f"http://127.0.0.1:{server.server_address[1]}/data", filename, chunksize=65536, timeout=5)
+    assert digest == hashlib.sha256(DATA).hexdigest()
+    with open(filename, "rb") as f:
+        assert f.read() == DATA
+    assert not os.path.exists(filename + ".part")
+
+
+def test_fresh_download(data_files, server, tmp_path):
+    fetch(data_files, server, str(tmp_path / "data"))
+    assert server.ranges == [None]
+
+
+def test_resume(data_files, server, tmp_path):
+    filename = str(tmp_path / "data")
+    with open(filename + ".part", "wb") as f:
+        f.write(DATA[:1000])
+    fetch(data_files, server, filename)
+    assert server.ranges == ["bytes=1000-"]
+
+
+def test_range_ignored(data_files, server, tmp_path):
+    filename = str(tmp_path / "data")
+    with open(filename + ".part", "wb") as f:
+        f.write(DATA[:1000])
+    server.ignore_range = True
+    fetch(data_files, server, filename)
+    assert server.ranges == ["bytes=1000-"]
+
+
+def test_already_complete(data_files, server, tmp_path):
+    filename = str(tmp_path / "data")
+    with open(filename + ".part", "wb") as f:
+        f.write(DATA)
+    fetch(data_files, server, filename)
+    assert server.ranges == [f"bytes={len(DATA)}-"]
+
+
+def test_truncated_download_is_retried(data_files, server, tmp_path):
+    server.truncate = 1
+    fetch(data_files, server, str(tmp_path / "data"))
+    #the retry resumes from what was received the first time
+    assert len(server.ranges) == 2 and server.ranges[0] is None and server.ranges[1] == f"bytes={len(DATA) // 2}-"
@@ -0,0 +1,110 @@
+"""Tests running custom queries in a worker process that can be cancelled"""
+import importlib.util
+import os.path
+import threading
+import time
+
+import pytest
+import stam
+
+NOTEBOOK = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "brieven-van-hooft-notebook.py")
+#every word combined with every word and every word again, far too many results to finish
+SLOW_QUERY = 'SELECT ANNOTATION ?a WHERE DATA "synthetic" "type" = "word"; { SELECT ANNOTATION ?b WHERE DATA "synthetic" "type" = "word"; ' \
+             '{ SELECT ANNOTATION ?c WHERE DATA "synthetic" "type" = "word"; } }'
+QUERY = 'SELECT ANNOTATION ?a WHERE DATA "synthetic" "word" = "woord7";'
+
+
+@pytest.fixture(scope="module")
+def query_jobs():
+    spec = importlib.util.spec_from_file_location("brieven_van_hooft_notebook", NOTEBOOK)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    _, defs = module.query_jobs.run()
+    #run as a module (rather than by marimo or as a script) the notebook does not know its own file
+    defs["QueryWorker"].notebook = NOTEBOOK
+    return defs
+
+
+@pytest.fixture(scope="module")
+def snapshot(tmp_path_factory):
+    """A CBOR snapshot of a synthetic STAM model with a few thousand words"""
+    words = [ f"woord{i}" for i in range(2000) ]
+    text = " ".join(words)
+    store = stam.AnnotationStore(id="synthetic")
+    resource = store.add_resource(id="synthetic.txt", text=text)
+    begin = 0
+    for word in words:
+        store.annotate(target=stam.Selector.textselector(resource, stam.Offset.simple(begin, begin + len(word))), data=[
+            {"set": "synthetic", "key": "type", "value": "word"},
+            {"set": "synthetic", "key": "word", "value": word},
+        ])
+        begin += len(word) + 1
+    filename = str(tmp_path_factory.mktemp("snapshot") / "synthetic.store.stam.cbor")
+    store.to_file(filename)
+    return filename
+
+
+def wait(job, timeout=60):
+    begintime = time.perf_counter()
+    while job.status == "running" and time.perf_counter() - begintime < timeout:
+        time.sleep(0.01)
+    return job.status
+
+
+def test_query(query_jobs, snapshot):
+    store = stam.AnnotationStore(file=snapshot)
+    job = query_jobs["QueryJob"](store, QUERY, profile=True, snapshot=snapshot)
+    assert job.worker is not None
+    assert wait(job) == "done", job.error
+    assert "woord7" in job.html
+    assert job.stats["results"] == 1
+    #the worker is kept for the next query
+    assert query_jobs["query_workers"].idle[snapshot] == [job.worker]
+    job = query_jobs["QueryJob"](store, "SELECT NONSENSE", snapshot=snapshot)
+    assert wait(job) == "failed"
+    assert job.error
+
+
+def test_cancel_slow_query(query_jobs, snapshot):
+    store = stam.AnnotationStore(file=snapshot)
+    job = query_jobs["QueryJob"](store, SLOW_QUERY, snapshot=snapshot)
+    #the caller keeps running while the worker evaluates the query (a query in a thread would hold the GIL)
+    ticks = 0
+    begintime = time.perf_counter()
+    while time.perf_counter() - begintime < 2.0:
+        time.sleep(0.01)
+        ticks += 1
+    assert ticks > 150
+    assert job.status == "running"
+    begintime = time.perf_counter()
+    job.cancel()
+    assert job.status == "cancelled"
+    assert job.worker.process.wait(timeout=5) is not None
+    assert time.perf_counter() - begintime < 1.0
+    #the killed worker is replaced by a new one, which evaluates the next query
+    job = query_jobs["QueryJob"](store, QUERY, snapshot=snapshot)
+    assert wait(job) == "done", job.error
+
+
+def test_timeout(query_jobs, snapshot):
+    store = stam.AnnotationStore(file=snapshot)
+    job = query_jobs["QueryJob"](store, SLOW_QUERY, timeout=2, snapshot=snapshot)
+    assert wait(job) == "timeout"
+    assert job.worker.process.wait(timeout=5) is not None
+
+
+def test_worker_dies(query_jobs, snapshot):
+    store = stam.AnnotationStore(file=snapshot)
+    job = query_jobs["QueryJob"](store, SLOW_QUERY, snapshot=snapshot)
+    time.sleep(1.0)
+    job.worker.process.kill()
+    assert wait(job) == "failed"
+    assert "worker process died" in job.error
+
+
+def test_without_snapshot(query_jobs, snapshot):
+    store = stam.AnnotationStore(file=snapshot)
+    job = query_jobs["QueryJob"](store, QUERY)
+    assert job.worker is None
+    assert wait(job) == "done"
+    assert "woord7" in job.html
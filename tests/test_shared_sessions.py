@@ -0,0 +1,168 @@
+"""Simulates several concurrent `marimo run` sessions (threads in one process) sharing the store"""
+import importlib.util
+import json
+import os.path
+import re
+import shutil
+import threading
+import time
+
+import pytest
+import stam
+
+NOTEBOOK = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "brieven-van-hooft-notebook.py")
+SESSIONS = 8
+
+
+@pytest.fixture(scope="module")
+def notebook():
+    spec = importlib.util.spec_from_file_location("brieven_van_hooft_notebook", NOTEBOOK)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def store_file(tmp_path):
+    """A small synthetic STAM model standing in for the real one"""
+    store = stam.AnnotationStore(id="synthetic")
+    resource = store.add_resource(id="hoof001hwva02.txt", text="Mijnheer, ick hebbe uwen brief ontfangen.")
+    store.annotate(target=stam.Selector.textselector(resource, stam.Offset.simple(0, 41)), id="hoof001hwva02_01_0000", data=[
+        {"set": "http://www.w3.org/ns/anno/", "key": "type", "value": "Letter"},
+        {"set": "brieven-van-hooft-metadata", "key": "dbnl_id", "value": "hoof001hwva02_01_0000"},
+        {"set": "brieven-van-hooft-categories", "key": "gender", "value": "male"},
+    ])
+    filename = str(tmp_path / "synthetic.store.stam.json")
+    store.set_filename(filename)
+    store.save()
+    return filename
+
+
+def run_sessions(function):
+    """Calls function() from several threads at once, returns their results"""
+    barrier = threading.Barrier(SESSIONS)
+    results = [None] * SESSIONS
+    errors = []
+
+    def session(i):
+        barrier.wait()
+        try:
+            results[i] = function()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=session, args=(i,)) for i in range(SESSIONS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors, errors
+    return results
+
+
+def test_store_is_loaded_once(notebook, store_file):
+    _, defs = notebook.shared_objects.run()
+    shared = defs["shared"]
+    loads = []
+
+    def load():
+        loads.append(threading.get_ident())
+        #loading takes a while, so the other sessions arrive while it is in progress
+        time.sleep(0.2)
+        return stam.AnnotationStore(file=store_file)
+
+    key = ("store", store_file)
+    stores = run_sessions(lambda: shared(key, load))
+    assert len(loads) == 1
+    assert all(store is stores[0] for store in stores)
+    assert stores[0].annotations_len() == 1
+    #a session that starts later gets the same store without loading it
+    assert run_sessions(lambda: shared(key, load))[0] is stores[0]
+    assert len(loads) == 1
+
+
+def test_main_thread_is_not_shared(notebook, store_file):
+    _, defs = notebook.shared_objects.run()
+    shared = defs["shared"]
+    key = ("store", store_file, "main")
+    assert shared(key, lambda: stam.AnnotationStore(file=store_file)) is not shared(key, lambda: stam.AnnotationStore(file=store_file))
+
+
+def test_concurrent_verification(notebook, store_file, tmp_path):
+    _, defs = notebook.data_files.run()
+    checksums = { store_file: defs["sha256_file"](store_file) }
+    manifest_file = str(tmp_path / "verified.json")
+    done = threading.Event()
+    reads = []
+
+    def read_manifest():
+        #a session reading the manifest must never see it partially written
+        while not done.is_set():
+            if os.path.exists(manifest_file):
+                with open(manifest_file, "r", encoding="utf-8") as f:
+                    reads.append(json.load(f))
+
+    reader = threading.Thread(target=read_manifest)
+    reader.start()
+    try:
+        results = run_sessions(lambda: [defs["verify_files"](checksums, manifest_file, force=True) for _ in range(20)])
+    finally:
+        done.set()
+        reader.join()
+    assert all(result == { store_file: True } for session in results for result in session)
+    assert reads
+
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch, store_file):
+    """A working directory holding the synthetic model in place of the downloaded data files, which the manifest
+    records as verified"""
+    with open(NOTEBOOK, "r", encoding="utf-8") as f:
+        checksums = dict(re.findall(r'"(hoof001hwva[^"]*)":\s*"([0-9a-f]{64})"', f.read()))
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv("BRIEVEN_VAN_HOOFT_PROFILE", raising=False)
+    manifest = {}
+    for filename, checksum in checksums.items():
+        if filename.endswith(".json"):
+            shutil.copy(store_file, filename)
+        else:
+            with open(filename, "w", encoding="utf-8") as f:
+                f.write("synthetic")
+        stat = os.stat(filename)
+        manifest[filename] = { "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": checksum }
+    with open("hoof001hwva.verified.json", "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    return tmp_path
+
+
+def test_letter_indices_are_built_once(notebook, data_dir, monkeypatch):
+    """Runs the notebook's loading path up to the letter indices in several sessions at once"""
+    loads = []
+    _AnnotationStore = stam.AnnotationStore
+
+    def load(*args, **kwargs):
+        loads.append(kwargs)
+        return _AnnotationStore(*args, **kwargs)
+
+    monkeypatch.setattr(stam, "AnnotationStore", load)
+
+    def session():
+        _, indices = notebook.letter_indices.run()
+        _, intervals = notebook.letter_interval_index.run()
+        return indices, intervals
+
+    results = run_sessions(session)
+    indices, intervals = results[0]
+    #the store is parsed once (the snapshot is written then) and indexed once
+    assert loads == [{ "file": "hoof001hwva.output.store.stam.json" }]
+    assert os.path.exists("hoof001hwva.output.store.stam.cbor")
+    for other_indices, other_intervals in results:
+        assert other_indices["letter_index"] is indices["letter_index"]
+        assert other_indices["letter_data_index"] is indices["letter_data_index"]
+        assert other_indices["letters_table"] is indices["letters_table"]
+        assert other_intervals["letter_intervals"] is intervals["letter_intervals"]
+    assert list(indices["letter_index"]) == ["hoof001hwva02_01_0000"]
+    assert indices["letter_data_index"][("brieven-van-hooft-categories", "gender", "male")] == ["hoof001hwva02_01_0000"]
+    assert indices["letters_table"]["gender"].to_list() == ["male"]
+    assert intervals["letter_intervals"].lookup("hoof001hwva02.txt", [0, 40, 41]).tolist() == ["hoof001hwva02_01_0000", "hoof001hwva02_01_0000", None]